@@ -1,22 +1,27 @@
 import sys
 import os
-import cv2
-import re
-import rawpy
-import pilgram
-import torch
-import numpy as np
-import picamera as picam
-from sid_model import preprocessing, init_sid_model
-from PIL import Image
+from startup_profiler import profiler
+from instrument import instrument
 from pathlib import Path
-from glob import glob
 from PyQt5 import QtCore, QtGui, QtWidgets
-from PyQt5.QtCore import QThreadPool, pyqtSlot, pyqtSignal
-from pidng.core import RPICAM2DNG
-
-from picamera import mmal, mmalobj, exc
+from PyQt5.QtCore import pyqtSignal
+profiler.mark("import PyQt5")
+import picamera as picam
+from picamera import mmal, exc
 from picamera.mmalobj import to_rational
+profiler.mark("import picamera")
+from thumb_cache import ThumbnailCache
+from gallery_loader import OrderedLoader
+from gallery_view import GalleryModel, GalleryView
+from filter_preview import FilterPreviewer
+from filter_export import FilterExporter
+from night_jobs import NightJobQueue
+from sid_cache import LazySIDModel
+from capture_pipeline import CaptureWriter
+from camera_control import CameraController
+from catalog import Catalog
+from folder_watcher import CatalogWatcher
+profiler.mark("import app modules")
 
 
 MMAL_PARAMETER_ANALOG_GAIN = mmal.MMAL_PARAMETER_GROUP_CAMERA + 0x59
@@ -24,6 +29,7 @@ MMAL_PARAMETER_DIGITAL_GAIN = mmal.MMAL_PARAMETER_GROUP_CAMERA + 0x5A
 
 us2s = 1000000
 img_folder = "./images/"
+
 def set_gain(camera, gain, value):
     """Set the analog gain of a PiCamera.
     
@@ -52,36 +58,42 @@ def set_digital_gain(camera, value):
     
     
 
-class ClickableImageLabelListener():
+class ImageSelection(QtCore.QObject):
+    """Single owner of the currently selected image.
+
+    Labels and the gallery strip report clicks here; the viewer is connected
+    to changed once, so a click costs the same however many labels were built.
+    """
+    changed = pyqtSignal()
+    
     def __init__(self, ):
-        self.image_label = []
-        
-        self.current_label = None
+        super(ImageSelection, self).__init__()
+        self.clear()
         
-    def add_image_label(self, image_label):
-        image_label.set_motion(self.current_label)
-        self.image_label.append(image_label)
-    
-    def set_main_viewer(self, main_label):
-        for label in self.image_label:
-            label.set_main_viewer(main_label)
-    
-    def set_text_label(self, text_label):
-        for label in self.image_label:
-            label.set_text_label(text_label)  
+    def select(self, file_name, message, img, filter_name=None):
+        self.file_name = file_name
+        self.message = message
+        self.img = img
+        self.filter_name = filter_name
+        self.changed.emit()
     
-    def remove_image_labels(self,):
-        for v in self.image_label:
-            v.clear()
+    def clear(self,):
+        self.file_name = None
+        self.message = None
+        self.img = None
+        self.filter_name = None
             
 class ClickableImageLabel(QtWidgets.QLabel):
     clicked = pyqtSignal()
     
-    def __init__(self, pixmap, file_name, message=None):
+    def __init__(self, pixmap, file_name, message=None, selection=None):
         super(ClickableImageLabel, self).__init__()
         self.setPixmap(pixmap)
         self.file_name = file_name
         self.message = message
+        self.selection = selection
+        if selection is not None:
+            self.clicked.connect(self.select)
     
     def set_img(self, img):
         self.img = img
@@ -92,31 +104,16 @@ class ClickableImageLabel(QtWidgets.QLabel):
         
         return QtWidgets.QLabel.mousePressEvent(self, event)
     
-    def set_motion(self, self_slot):
-        self.clicked.connect(lambda : self.sent_self(self_slot))
-
-    def sent_self(self, self_slot):
-        self_slot[0] = self
-    
-    def set_main_viewer(self, main_label):
-        self.clicked.connect(lambda : self.show_image(main_label))
-    
-    def set_text_label(self, text_label):
-        self.clicked.connect(lambda : self.show_text(text_label))
-    
-    def show_text(self, text_label):
-        text_label.setText(self.message)
-    
-    def show_image(self,main_label):
-        pixmap = QtGui.QPixmap.fromImage(self.img)
-        main_label.setPixmap(pixmap)
+    def select(self,):
+        self.selection.select(self.file_name, self.message, self.img, filter_name=self.message)
 
 class CameraMenu(object):
-    def __init__(self,):
+    def __init__(self, catalog):
+        self.catalog = catalog
         self.widget = QtWidgets.QWidget()
         self.widget_filter = QtWidgets.QWidget(self.widget)
-        self.image_listener = ClickableImageLabelListener()
-        self.image_listener_main = ClickableImageLabelListener()
+        self.selection = ImageSelection()
+        self.selection.changed.connect(self.show_selection)
         self.option_menu = QtWidgets.QMenu(self.widget)
         self.filter_names = ["_1977","aden","brannan","brooklyn","clarendon","earlybird","gingham", "hudson", 
                             "inkwell","kelvin","lark","lofi","maven","mayfair","moon","nashville","perpetua",
@@ -124,47 +121,46 @@ class CameraMenu(object):
         
         
         
-        self.old_img_paths = glob(f"{img_folder}/*")
-        self.old_img_paths.sort(key=lambda x: int(re.sub("\D", '', x)))
+        self.catalog_watcher = CatalogWatcher(catalog, img_folder)
+        self.catalog_watcher.inserted.connect(self.file_inserted)
+        self.catalog_watcher.removed.connect(self.file_removed)
+        self.catalog_watcher.updated.connect(self.file_updated)
         
-        self.image_label = []
         self.filter_label = []
-        self.tex_label = []
         self.filter_text_label = []
-        self.current_label = [None]
-        
-        self.sid_model = init_sid_model("/home/pi/workspace/digtial_camera/pth.txt")
-        
-    def set_main_viewer(self, main_label):
-        for label in self.image_label:
-            label.set_main_viewer(main_label)
-
-    def set_main_viewer_filters(self, main_label):
-        for label in self.filter_label:
-            label.set_main_viewer(main_label)
-            
-    def set_text_label(self, text_label):
-        for label in self.image_label:
-            label.set_text_label(text_label)
-            
-    def set_text_label_filters(self, text_label):
-        for label in self.filter_label:
-            label.set_text_label(text_label)
-    
-    def remove_image_labels(self,):
-        for v in self.image_label:
-            v.clear()
-        for v in self.tex_label:
-            v.clear()
+        self.thumb_cache = ThumbnailCache()
+        self.gallery_model = GalleryModel(self.thumb_cache, sort_key=self.gallery_sort_key)
+        self.filter_previewer = FilterPreviewer()
+        self.filter_loader = OrderedLoader()
+        self.filter_loader.ready.connect(self.add_filter_image)
+        self.filter_exporter = FilterExporter(self.filter_previewer.get_pool)
+        self.filter_exporter.progress.connect(self.filter_export_progress)
+        self.filter_exporter.finished.connect(self.filter_exported)
+        self.filter_exporter.failed.connect(lambda out_path, reason: self.statusLabel.setText(f"{Path(out_path).name}: {reason}"))
+        self.dng_loader = OrderedLoader(max_threads=1)
+        self.dng_loader.ready.connect(self.dng_rendered)
+        
+        self.sn_tile = 512
+        self.sn_overlap = 32
+        self.sid_model = LazySIDModel("/home/pi/workspace/digtial_camera/pth.txt")
+        self.night_jobs = NightJobQueue(self.sid_model.get, tile=self.sn_tile, overlap=self.sn_overlap)
+        self.night_jobs.progress.connect(self.night_progress)
+        self.night_jobs.finished.connect(self.night_finished)
+        self.night_jobs.failed.connect(self.night_failed)
+        self.night_jobs.preview.connect(self.night_preview)
+        
+    def show_selection(self,):
+        self.MainImagelabel.setPixmap(QtGui.QPixmap.fromImage(self.selection.img))
+        self.toolButton.setText(self.selection.message)
+    
     def remove_filter_labels(self,):
-        for v in self.filter_text_label:
-            v.clear()
-        for v in self.filter_label:
-            v.clear()
-        
-    def set_main_image(self,):
-        file = self.image_listener.current_label.file_name
-        img = QtGui.QImage(file)
+        if self.selection.filter_name is not None:
+            self.selection.clear()
+        for v in self.filter_text_label + self.filter_label:
+            self.gridLayout_2.removeWidget(v)
+            v.deleteLater()
+        self.filter_text_label = []
+        self.filter_label = []
    
     def set_widget_motion(self,):
         self.backButton.clicked.connect(self.hide_window)
@@ -173,214 +169,223 @@ class CameraMenu(object):
         self.pushButton.clicked.connect(self.save_filter)
      
     def hide_filter_window(self,):
+        self.filter_loader.cancel()
         self.widget_filter.hide()
-        self.scrollAreaWidgetContents.show()
-        self.scrollArea.show()
+        self.gallery_view.show()
     def hide_window(self,):
+        self.cancel_loading()
         self.widget.hide()
         
     def show_window(self,):
-        self.load_images(False)
         self.widget.show()
     
     def set_option_menu(self,):
         self.delete_act = QtWidgets.QAction("Delete", self.widget)
         self.vis_dng_act = QtWidgets.QAction("Visual DNG", self.widget)
+        self.vis_dng_hq_act = QtWidgets.QAction("Visual DNG (HQ)", self.widget)
         self.vis_filters_act = QtWidgets.QAction("Filters", self.widget)
         self.super_night_act = QtWidgets.QAction("Super Night", self.widget)
+        self.cancel_night_act = QtWidgets.QAction("Cancel Super Night", self.widget)
         
         
         self.delete_act.triggered.connect(self.option_menu_motion)
         self.vis_dng_act.triggered.connect(self.option_menu_motion)
+        self.vis_dng_hq_act.triggered.connect(self.option_menu_motion)
         self.vis_filters_act.triggered.connect(self.option_menu_motion)
         self.super_night_act.triggered.connect(self.option_menu_motion)
+        self.cancel_night_act.triggered.connect(self.option_menu_motion)
         
         
         self.option_menu.addAction(self.delete_act)
         self.option_menu.addAction(self.vis_dng_act)
+        self.option_menu.addAction(self.vis_dng_hq_act)
         self.option_menu.addAction(self.vis_filters_act)
         self.option_menu.addAction(self.super_night_act)
+        self.option_menu.addAction(self.cancel_night_act)
         
         self.toolButton.setMenu(self.option_menu)
  
 
     def option_menu_motion(self,):
         if self.widget.sender() == self.delete_act:
-            os.remove(f"{img_folder}/{self.toolButton.text()}")
-            self.load_images(init=True)
+            file_path = f"{img_folder}/{self.toolButton.text()}"
+            self.thumb_cache.invalidate(file_path)
+            os.remove(file_path)
+            self.catalog.remove(self.toolButton.text())
             
         if self.widget.sender() == self.vis_dng_act:
             self.visual_dng()
             
+        if self.widget.sender() == self.vis_dng_hq_act:
+            self.visual_dng(mode="hq")
+            
         if self.widget.sender() == self.vis_filters_act:
-            self.scrollAreaWidgetContents.hide()
-            self.scrollArea.hide()
+            self.gallery_view.hide()
+            self.cancel_loading()
             self.widget_filter.show()
             self.visual_filters()
             
         if self.widget.sender() == self.super_night_act:
             self.super_night()
             
-    @torch.no_grad()
+        if self.widget.sender() == self.cancel_night_act:
+            self.night_jobs.cancel()
+            
     def super_night(self, ):
-        file_name = self.toolButton.text()
-        file_stem = file_name.split(".")[0]
-        file_type = file_name.split(".")[1]
-        file_path = f"{img_folder}/{file_name}"
-        
-        if file_type == 'dng':
-            inp = preprocessing(file_path)
-            out = self.sid_model(torch.tensor(inp[:, :, :2016])[None])[0]
-            out = torch.clip(out, 0, 1)
-            out = out.permute(1,2,0).numpy()[:,:,::-1] * 255.
-            out = out.astype("uint8")
-            cv2.imwrite(f"{img_folder}/{file_stem}_SN.jpeg", out)
-            self.load_images(init=True)  
+        file_names = [self.gallery_model.file_name(index.row()) for index in self.gallery_view.selectedIndexes()]
+        if self.toolButton.text() not in file_names:
+            file_names.append(self.toolButton.text())
+        
+        file_paths = [f"{img_folder}/{file_name}" for file_name in file_names if file_name.endswith(".dng")]
+        if file_paths:
+            self.night_jobs.submit(file_paths)
             
+    def night_progress(self, file_path, fraction, queued):
+        self.statusLabel.setText(f"SN {Path(file_path).name}: {int(fraction * 100)}% ({queued} queued)")
+    
+    def night_preview(self, file_path, img):
+        if self.toolButton.text() != Path(file_path).name:
+            return
+        h, w = img.shape[:2]
+        qimg = QtGui.QImage(img.data, w, h, 3 * w, QtGui.QImage.Format_RGB888)
+        qimg = qimg.scaled(320, 240, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation)
+        self.MainImagelabel.setPixmap(QtGui.QPixmap.fromImage(qimg))
+        self.statusLabel.setText(f"SN {Path(file_path).name}: preview, rendering...")
+    
+    def night_finished(self, file_path, out_path):
+        self.statusLabel.setText(f"SN {Path(file_path).name}: done")
+        self.catalog.add(Path(out_path).name, "sn", Path(file_path).name)
+        if self.toolButton.text() == Path(file_path).name:
+            reader = QtGui.QImageReader(out_path)
+            reader.setScaledSize(reader.size().scaled(320, 240, QtCore.Qt.KeepAspectRatio))
+            self.MainImagelabel.setPixmap(QtGui.QPixmap.fromImage(reader.read()))
+    
+    def night_failed(self, file_path, reason):
+        self.statusLabel.setText(f"SN {Path(file_path).name}: {reason}")
+        if self.toolButton.text() == Path(file_path).name and self.selection.img is not None:
+            self.MainImagelabel.setPixmap(QtGui.QPixmap.fromImage(self.selection.img))
             
-    def visual_dng(self,):
+            
+    def visual_dng(self, mode="quick"):
         file_name = self.toolButton.text()
         file_stem = file_name.split(".")[0]
         file_type = file_name.split(".")[1]
-        file_path = f"{img_folder}/{file_name}"
         
         if file_type == "dng":
-            raw = rawpy.imread(file_path).postprocess(use_camera_wb=True, half_size=True)[:,:,::-1]
-            cv2.imwrite(f"{img_folder}/{file_stem}_VIS.jpeg", raw)
-            self.load_images(init=True)            
+            self.statusLabel.setText(f"VIS {file_name} ({mode})")
+            self.dng_loader.submit(self.render_dng, [(file_name, f"{file_stem}_VIS.jpeg", mode)])
+    
+    def render_dng(self, file_name, out_name, mode):
+        from quicklook import visualize_dng
+        wrote = visualize_dng(f"{img_folder}/{file_name}", f"{img_folder}/{out_name}", mode)
+        return file_name, out_name, wrote
+    
+    def dng_rendered(self, i, result):
+        if result is None:
+            self.statusLabel.setText("VIS failed")
+            return
+        file_name, out_name, wrote = result
+        self.statusLabel.setText(f"VIS {file_name}: {'done' if wrote else 'cached'}")
+        if wrote or self.catalog.kind(out_name) is None:
+            self.catalog.add(out_name, "vis", file_name)
     
     def visual_filters(self, ):
         self.remove_filter_labels()
-            
-        for i,name in enumerate(self.filter_names):
-            filter_func = getattr(pilgram, name) 
-            file_name = self.toolButton.text()
-            file_path = f"{img_folder}/{file_name}"
-        
-            img = cv2.imread(file_path)
-            img = cv2.resize(img, (320, 240))
-            img = Image.fromarray(img)
-            img = filter_func(img)
-            img = np.ascontiguousarray(np.array(img)[:,:,::-1])
-     
-            img = QtGui.QImage(img, 320, 240, 3*320, QtGui.QImage.Format_RGB888)
-            img_resized = img.scaled(75, 75, aspectRatioMode=QtCore.Qt.KeepAspectRatio, 
-                                  transformMode = QtCore.Qt.FastTransformation)
-            
-            
-            image_label = ClickableImageLabel(QtGui.QPixmap.fromImage(img_resized), self.toolButton.text(), name)
-            image_label.set_img(img)
-            image_label.set_motion(self.current_label)
-            self.filter_label.append(image_label)
-            
-
+        self.filter_loader.cancel()
         
-            text_label = QtWidgets.QLabel(name)
-            text_label.setAlignment(QtCore.Qt.AlignCenter)
-            self.filter_text_label.append(text_label)
-
-            self.gridLayout_2.addWidget(image_label, 0, i)
-            self.gridLayout_2.addWidget(text_label,1,i)    
-        
-        self.set_main_viewer_filters(self.MainImagelabel)
-        self.set_text_label_filters(self.toolButton)
-        self.load_images(init=True)
-        
-    def load_images(self, init=True):
-        if init:
-            st = 0
-            self.remove_image_labels()
-            img_paths = glob(f"{img_folder}/*")
-            img_paths.sort(key=lambda x: int(re.sub("\D", '', x)))
-            
-            self.old_img_paths = img_paths
-            print(f"load_images init=True:{len(self.image_listener.image_label)}, ")
-        else:
-            st = len(self.old_img_paths)
-            
-            new_img_paths = glob(f"{img_folder}/*")
-            new_img_paths = set(new_img_paths)
-            
-            img_paths = list(new_img_paths - set(self.old_img_paths))
-            img_paths.sort(key=lambda x: int(re.sub("\D", '', x)))
-        
-        
-            self.old_img_paths = new_img_paths
-
-        for i, file in enumerate(img_paths, st):
-
-            img = QtGui.QImage(file)
-            img_large = img.scaled(320, 240,aspectRatioMode=QtCore.Qt.KeepAspectRatio, transformMode = QtCore.Qt.FastTransformation)
-            img_resized = img.scaled(75,75,aspectRatioMode=QtCore.Qt.KeepAspectRatio, transformMode = QtCore.Qt.FastTransformation)
-
-            image_label = ClickableImageLabel(QtGui.QPixmap.fromImage(img_resized), Path(file).name, Path(file).name)
-            image_label.set_img(img_large)
-            
-
-            self.image_label.append(image_label)
-            tex_label = QtWidgets.QLabel(self.scrollAreaWidgetContents)
-            tex_label.setText(Path(file).name)
-            tex_label.setAlignment(QtCore.Qt.AlignCenter)
+        file_path = f"{img_folder}/{self.toolButton.text()}"
+        self.filter_loader.submit(self.render_filter_preview, [(file_path, name) for name in self.filter_names])
+    
+    def render_filter_preview(self, file_path, name):
+        img = self.filter_previewer.render(file_path, name)
+        if img is None:
+            return None
+        import numpy as np
+        img = np.ascontiguousarray(img)
+ 
+        img = QtGui.QImage(img.data, 320, 240, 3*320, QtGui.QImage.Format_RGB888).copy()
+        img_resized = img.scaled(75, 75, aspectRatioMode=QtCore.Qt.KeepAspectRatio, 
+                              transformMode = QtCore.Qt.FastTransformation)
+        return name, img_resized, img
+    
+    def add_filter_image(self, i, result):
+        if result is None:
+            return
+        name, img_resized, img = result
+        
+        image_label = ClickableImageLabel(QtGui.QPixmap.fromImage(img_resized), self.toolButton.text(), name, self.selection)
+        image_label.set_img(img)
+        self.filter_label.append(image_label)
+    
+        text_label = QtWidgets.QLabel(name)
+        text_label.setAlignment(QtCore.Qt.AlignCenter)
+        self.filter_text_label.append(text_label)
 
-            
-            self.tex_label.append(tex_label)
-            
-            self.gridLayout.addWidget(image_label, 0, i)
-            self.gridLayout.addWidget(tex_label, 1, i)    
+        self.gridLayout_2.addWidget(image_label, 0, i)
+        self.gridLayout_2.addWidget(text_label,1,i)    
         
-        self.set_main_viewer(self.MainImagelabel)
-        self.set_text_label(self.toolButton)
+    def gallery_sort_key(self, file):
+        return self.catalog.position(Path(file).name)
+    
+    def load_images(self,):
+        self.gallery_model.set_files([f"{img_folder}/{name}" for name in self.catalog.names()])
+    
+    def file_inserted(self, name):
+        self.gallery_model.insert_file(f"{img_folder}/{name}")
+    
+    def file_removed(self, name):
+        file_path = f"{img_folder}/{name}"
+        self.thumb_cache.invalidate(file_path)
+        self.gallery_model.remove_file(file_path)
+    
+    def file_updated(self, name):
+        file_path = f"{img_folder}/{name}"
+        self.thumb_cache.invalidate(file_path)
+        self.gallery_model.insert_file(file_path)
+    
+    def show_gallery_image(self, index):
+        file_name = self.gallery_model.file_name(index.row())
+        self.selection.select(file_name, file_name, self.gallery_model.preview(index.row()))
+    
+    def cancel_loading(self,):
+        self.gallery_model.cancel()
+        self.filter_loader.cancel()
     
     def save_filter(self,):
-        file_name = self.current_label[0].file_name
-        filter_name = self.current_label[0].message
-        filter_func = getattr(pilgram, filter_name) 
+        if self.selection.filter_name is None:
+            return
+        file_name = self.selection.file_name
+        filter_name = self.selection.filter_name
         file_stem = file_name.split(".")[0]
-        file_path = f"{img_folder}/{file_name}"
-
-        img = cv2.imread(file_path)
-        img = Image.fromarray(img)
-        img = filter_func(img)
-        img = np.array(img)
-        cv2.imwrite(f"{img_folder}/{file_stem}.JPG", img)
-        self.load_images(init=True)
-    
-    def init_sid_model(self,):
-        pth = open("./pth.txt", 'rb')
-        pth.seek(0)
-        model = SeeInDark()
-        model = model.eval()
-        model = quantize_fx.prepare_fx(model, {'': torch.quantization.default_qconfig})
-        model = quantize_fx.convert_fx(model)
-        model.load_state_dict(torch.load(pth))
-        self.sid_model = model
-       
+        out_name = f"{file_stem}_{filter_name}.jpeg"
+        self.statusLabel.setText(f"{out_name}: 0%")
+        self.filter_exporter.submit(f"{img_folder}/{file_name}", f"{img_folder}/{out_name}", filter_name)
+    
+    def filter_export_progress(self, out_path, fraction):
+        self.statusLabel.setText(f"{Path(out_path).name}: {int(fraction * 100)}%")
+    
+    def filter_exported(self, file_path, out_path):
+        self.statusLabel.setText(f"{Path(out_path).name}: saved")
+        self.catalog.add(Path(out_path).name, "filter", Path(file_path).name)
+    
     def init_ui(self,):
         self.setupUi()
         self.retranslateUi()
-        self.load_images(True)
+        self.load_images()
         self.set_option_menu()
+        self.night_jobs.start()
         
         
     def setupUi(self,):
         Form = self.widget
         Form.setObjectName("Form")
         Form.resize(600, 400)
-        self.scrollArea = QtWidgets.QScrollArea(Form)
-        self.scrollArea.setEnabled(True)
-        self.scrollArea.setGeometry(QtCore.QRect(10, 250, 580, 101))
-        self.scrollArea.setWidgetResizable(True)
-        self.scrollArea.setObjectName("scrollArea")
-        self.scrollAreaWidgetContents = QtWidgets.QWidget()
-        self.scrollAreaWidgetContents.setGeometry(QtCore.QRect(0, 0, 459, 99))
-        self.scrollAreaWidgetContents.setObjectName("scrollAreaWidgetContents")
-        self.gridLayoutWidget = QtWidgets.QWidget(self.scrollAreaWidgetContents)
-        self.gridLayoutWidget.setGeometry(QtCore.QRect(10, 10, 441, 71))
-        self.gridLayoutWidget.setObjectName("gridLayoutWidget")
-        self.gridLayout = QtWidgets.QGridLayout(self.scrollAreaWidgetContents)
-        self.gridLayout.setContentsMargins(0, 0, 0, 0)
-        self.gridLayout.setObjectName("gridLayout")
-        self.scrollArea.setWidget(self.scrollAreaWidgetContents)
+        self.gallery_view = GalleryView(Form)
+        self.gallery_view.setGeometry(QtCore.QRect(10, 250, 580, 101))
+        self.gallery_view.setObjectName("gallery_view")
+        self.gallery_view.setModel(self.gallery_model)
+        self.gallery_view.setSelectionMode(QtWidgets.QAbstractItemView.ExtendedSelection)
+        self.gallery_view.clicked.connect(self.show_gallery_image)
         self.backButton = QtWidgets.QPushButton(Form)
         self.backButton.setGeometry(QtCore.QRect(349, 10, 221, 30))
         self.backButton.setObjectName("backButton")
@@ -392,6 +397,9 @@ class CameraMenu(object):
         self.MainImagelabel.setGeometry(QtCore.QRect(5, 5, 320, 240))
         self.MainImagelabel.setText("")
         self.MainImagelabel.setObjectName("MainImagelabel")
+        self.statusLabel = QtWidgets.QLabel(Form)
+        self.statusLabel.setGeometry(QtCore.QRect(350, 90, 221, 29))
+        self.statusLabel.setObjectName("statusLabel")
         
         
         
@@ -446,13 +454,20 @@ class CameraMenu(object):
 
 
 class PreviewWindow(object):
-    def __init__(self,):
+    def __init__(self, catalog, camera=None):
+        self.catalog = catalog
         self.window = QtWidgets.QMainWindow()
-        self.camera = picam.PiCamera()
-        set_digital_gain(self.camera, 1)
+        self.camera = camera if camera is not None else picam.PiCamera()
+        self.capture_writer = CaptureWriter(img_folder, catalog)
+        self.control = CameraController(self.camera, {"analog_gain": set_analog_gain, "digital_gain": set_digital_gain},
+                                        self.capture_writer)
+        self.control.update(digital_gain=1)
         self.iso_step = 10
         self.shutter_step = [10,13,15,20,25,30,40,50,60,80,100,125,160,200,250,320,400,500,640,800,1000,1250,1600,2000,2500,3200,4000]
-        self.dng_convert = RPICAM2DNG()
+        self.burst_count = 5
+        self.burst = None
+        self.night_count = 4
+        self.night_stack = None
         
     
     def init_widget_status(self,):
@@ -462,26 +477,41 @@ class PreviewWindow(object):
         
     def set_widget_event(self,):
         self.captureButton.clicked.connect(self.capture_raw)
+        self.burstButton.clicked.connect(self.capture_burst)
+        self.nightButton.clicked.connect(self.capture_night)
+        self.control.applied.connect(self.camera_applied)
+        self.control.captured.connect(self.frames_captured)
+        self.control.failed.connect(lambda reason: self.statusbar.showMessage(f"camera: {reason}"))
+        self.capture_writer.saved.connect(self.capture_saved)
+        self.capture_writer.stored.connect(self.capture_stored)
+        self.capture_writer.failed.connect(lambda idx, reason: self.statusbar.showMessage(f"{idx}.jpg: {reason}"))
         self.MenuButton.clicked.connect(self.stop_camera)
         self.MenuButton.clicked.connect(self.hiden_window)
         self.AutoModeBox.stateChanged.connect(self.camera_preview)
+        if instrument.enabled:
+            self.instrument_version = 0
+            self.instrument_timer = QtCore.QTimer(self.window)
+            self.instrument_timer.timeout.connect(self.show_instrument)
+            self.instrument_timer.start(1000)
         self.ISOverticalScrollBar.valueChanged.connect(lambda : self.camera_preview(state=0, preview=False))
         self.ShutterverticalScrollBar.valueChanged.connect(lambda : self.camera_preview(state=0, preview=False))
         
     def camera_preview(self, state=0, preview=False):
         if state > 0:
             self.disable_iso_shutter()
-            self.camera.exposure_mode = 'auto'
-            self.camera.iso = 0
-            self.camera.shutter_speed = 0
+            self.control.update(exposure_mode='auto', iso=0, shutter_speed=0)
             
         else:
             self.enable_iso_shutter()
-            self.camera.iso = self.ISOverticalScrollBar.value() * self.iso_step
-            self.camera.shutter_speed = self.set_shutter(self.shutter_step[self.ShutterverticalScrollBar.value()])  
+            self.control.update(iso=self.ISOverticalScrollBar.value() * self.iso_step,
+                                shutter_speed=self.set_shutter(self.shutter_step[self.ShutterverticalScrollBar.value()]))
             self.set_iso_shutter_text()
         if preview:
-            self.camera.start_preview(fullscreen=False, window=(5,40,500,int(500/4*3)))   
+            self.control.start_preview(fullscreen=False, window=(5,40,500,int(500/4*3)))   
+            
+    def camera_applied(self, state):
+        if state.get("shutter_speed"):
+            self.statusbar.showMessage(f"applied ISO {state['iso']}, shutter {state['shutter_speed'] / us2s:.4f} s")
             
             
     def disable_iso_shutter(self,):
@@ -500,22 +530,74 @@ class PreviewWindow(object):
         self.Shutterlabel.setText(f"1/{str(self.shutter_step[self.ShutterverticalScrollBar.value()])} (s)")
         
     def stop_camera(self,):
-        self.camera.stop_preview()
+        self.control.stop_preview()
 
     def capture_raw(self, ):
-        idx = self.get_file_idx(img_folder)
-        self.camera.capture(output=f"{img_folder}/{idx}.jpg", format='jpeg', bayer=True, use_video_port=False)
-        self.dng_convert.convert(f"{img_folder}/{idx}.jpg")
-        self.camera_preview(self.AutoModeBox.checkState())
-        
-    def get_file_idx(self, img_folder = "./images/"):
-        if len(os.listdir(img_folder)) == 0:
-            img_idx = 0
+        self.capture(1)
+        
+    def capture_burst(self, ):
+        self.capture(self.burst_count)
+        
+    def capture_night(self, ):
+        self.control.capture(self.night_count, "night")
+        
+    def frames_captured(self, tag, frames, st, readout):
+        if tag == "night":
+            self.night_captured(frames)
         else:
-            img_idx = max([int(x.split(".")[0].split("_")[0]) for x in os.listdir(img_folder)]) + 1
-        return img_idx   
-
-    
+            self.store_frames(frames, st, readout)
+            
+    def night_captured(self, frames):
+        idx = self.catalog.allocate()
+        self.capture_writer.submit(idx, frames[0])
+        # the controller reserved writer room for every frame, only the first one is written
+        self.capture_writer.release(len(frames) - 1)
+        if self.night_stack is not None:
+            self.night_stack(f"{img_folder}/{idx}.dng", frames)
+        self.statusbar.showMessage(f"night stack {idx}: {len(frames)} frames queued")
+        
+    def night_stacked(self, file_path, timings):
+        from night_stack import format_timings
+        self.statusbar.showMessage(f"night stack {Path(file_path).stem}: {format_timings(timings)}")
+        
+    def capture(self, count):
+        self.control.capture(count)
+        
+    def store_frames(self, frames, st, readout):
+        count = len(frames)
+        idxs = [self.catalog.allocate() for _ in frames]
+        if count > 1:
+            self.burst = {"start": st, "remaining": set(idxs), "count": count, "readout": readout}
+        for idx, data in zip(idxs, frames):
+            self.capture_writer.submit(idx, data)
+        
+    def capture_stored(self, idx, stats):
+        if self.burst is not None:
+            return
+        dng = stats.get("dng_bytes")
+        ratio = f", DNG {dng / 1e6:.1f} MB ({dng / stats['raw_bytes'] * 100:.0f}% of raw)" if dng else ""
+        verified = {True: ", verified", False: ", unverified, Bayer JPEG kept", None: ""}[stats["verified"]]
+        if "verify_error" in stats:
+            verified += f" ({stats['verify_error']})"
+        self.statusbar.showMessage(f"{idx}: wrote {stats['bytes'] / 1e6:.1f} MB at {stats['mb_s']:.1f} MB/s{ratio}{verified}")
+        
+    def capture_saved(self, idx, file_path, t):
+        if self.burst is None or idx not in self.burst["remaining"]:
+            self.statusbar.showMessage(f"saved {Path(file_path).name} ({self.capture_writer.pending()} pending)")
+            return
+        self.burst["remaining"].discard(idx)
+        if not self.burst["remaining"]:
+            count = self.burst["count"]
+            sustained = count / (t - self.burst["start"])
+            readout = count / self.burst["readout"]
+            self.statusbar.showMessage(f"burst {count}: {sustained:.2f} shots/s sustained, {readout:.2f} shots/s readout")
+            self.burst = None
+        
+    def show_instrument(self,):
+        if instrument.version != self.instrument_version:
+            self.instrument_version = instrument.version
+            self.statusbar.showMessage(instrument.summary(instrument.last_op))
+        
     def show_main_window(self,):
         self.window.show() 
         self.camera_preview(self.AutoModeBox.checkState(), preview=True)
@@ -539,7 +621,7 @@ class PreviewWindow(object):
         self.centralwidget = QtWidgets.QWidget(MainWindow)
         self.centralwidget.setObjectName("centralwidget")
         self.widget = QtWidgets.QWidget(self.centralwidget)
-        self.widget.setGeometry(QtCore.QRect(505, 10, 85, 206))
+        self.widget.setGeometry(QtCore.QRect(505, 10, 85, 270))
         self.widget.setObjectName("widget")
         self.verticalLayout_3 = QtWidgets.QVBoxLayout(self.widget)
         self.verticalLayout_3.setContentsMargins(0, 0, 0, 0)
@@ -548,6 +630,12 @@ class PreviewWindow(object):
         self.captureButton.setLayoutDirection(QtCore.Qt.LeftToRight)
         self.captureButton.setObjectName("captureButton")
         self.verticalLayout_3.addWidget(self.captureButton)
+        self.burstButton = QtWidgets.QPushButton(self.widget)
+        self.burstButton.setObjectName("burstButton")
+        self.verticalLayout_3.addWidget(self.burstButton)
+        self.nightButton = QtWidgets.QPushButton(self.widget)
+        self.nightButton.setObjectName("nightButton")
+        self.verticalLayout_3.addWidget(self.nightButton)
         self.AutoModeBox = QtWidgets.QCheckBox(self.widget)
         self.AutoModeBox.setObjectName("AutoModeBox")
         self.verticalLayout_3.addWidget(self.AutoModeBox)
@@ -624,6 +712,8 @@ class PreviewWindow(object):
         _translate = QtCore.QCoreApplication.translate
         MainWindow.setWindowTitle(_translate("MainWindow", "MainWindow"))
         self.captureButton.setText(_translate("MainWindow", "Capture"))
+        self.burstButton.setText(_translate("MainWindow", "Burst"))
+        self.nightButton.setText(_translate("MainWindow", "Night"))
         self.AutoModeBox.setText(_translate("MainWindow", "Auto Mode"))
         self.MenuButton.setText(_translate("MainWindow", "Menu"))
         self.label.setText(_translate("MainWindow", "ISO"))
@@ -634,28 +724,42 @@ class PreviewWindow(object):
 
 
 class CameraApp(object):
-    def __init__(self,):
-        self.app = QtWidgets.QApplication(sys.argv)
-        self.preview_window = PreviewWindow()
-        self.menu_window = CameraMenu()
+    def __init__(self, camera=None):
+        self.app = QtWidgets.QApplication.instance() or QtWidgets.QApplication(sys.argv)
+        profiler.mark("QApplication")
+        self.catalog = Catalog(img_folder)
+        self.preview_window = PreviewWindow(self.catalog, camera)
+        profiler.mark("PreviewWindow (PiCamera)")
+        self.menu_window = CameraMenu(self.catalog)
+        profiler.mark("CameraMenu")
         
         
+    def preview_started(self,):
+        # runs on the camera thread right after start_preview returned
+        profiler.mark("start_preview")
+        profiler.report()
+
     def run_app(self,):
         
+        self.preview_window.control.preview_started.connect(self.preview_started, QtCore.Qt.DirectConnection)
         self.preview_window.init_ui()
+        profiler.mark("preview ui")
         self.menu_window.init_ui()
         
         self.preview_window.MenuButton.clicked.connect(self.menu_window.show_window)
+        self.preview_window.night_stack = self.menu_window.night_jobs.submit_stack
+        self.menu_window.night_jobs.stacked.connect(self.preview_window.night_stacked)
 
         self.preview_window.window.show()
         
         self.menu_window.set_widget_motion()
         self.menu_window.backButton.clicked.connect(self.preview_window.show_main_window)
+        QtCore.QTimer.singleShot(3000, self.menu_window.sid_model.warm)
     
     
         
         sys.exit(self.app.exec_())
 
-app = CameraApp()
-
-app.run_app()
\ No newline at end of file
+if __name__ == "__main__":
+    app = CameraApp()
+    app.run_app()
\ No newline at end of file
@@ -0,0 +1,219 @@
+"""Headless batch processing of the images folder.
+
+Runs the menu operations over a folder or globs without Qt:
+
+    python batch.py --ops vis,filter:clarendon,sn [--workers 4] [paths or globs ...]
+
+vis / vis_hq render DNGs to _VIS.jpeg, filter:<name> exports captures with a
+filter, sn runs Super Night on DNGs. vis and filter tasks run on a process
+pool; sn runs in the main process so the model is loaded once and torch gets
+all the cores. An output is skipped when the journal records it as done for
+the current input, so an interrupted batch resumes where it stopped.
+Outputs are added to the catalog unless --no-catalog is given.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import traceback
+from pathlib import Path
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+
+from catalog import Catalog, classify
+
+
+img_folder = "./images/"
+journal_path = "./.batch_journal.jsonl"
+
+
+class InlinePool(object):
+    """Executor interface running calls in the calling process, used for the strips of a filter export inside a worker."""
+    def submit(self, func, *args):
+        future = Future()
+        future.set_result(func(*args))
+        return future
+
+
+def output_name(op, name):
+    stem = Path(name).stem
+    if op in ("vis", "vis_hq"):
+        return f"{stem}_VIS.jpeg"
+    if op == "sn":
+        return f"{stem}_SN.jpeg"
+    return f"{stem}_{op.split(':', 1)[1]}.jpeg"
+
+
+def accepts(op, name):
+    kind, _ = classify(name)
+    if op.startswith("filter:"):
+        return kind == "capture"
+    return kind == "dng"
+
+
+def run_task(op, file_path, out_path):
+    """Run one op in a worker, returns (op, file_path, out_path, seconds, wrote)."""
+    st = time.perf_counter()
+    wrote = True
+    if op in ("vis", "vis_hq"):
+        from quicklook import visualize_dng
+        wrote = visualize_dng(file_path, out_path, "quick" if op == "vis" else "hq")
+    elif op.startswith("filter:"):
+        from fast_filters import export_filtered
+        export_filtered(file_path, out_path, op.split(":", 1)[1], InlinePool())
+    else:
+        raise ValueError(f"unknown op {op}")
+    return op, file_path, out_path, time.perf_counter() - st, wrote
+
+
+def prebake(names):
+    """Bake the LUTs of the filters in names here, before the workers start, so they only load them."""
+    if not names:
+        return
+    import fast_filters
+    for name in names:
+        st = time.perf_counter()
+        fast_filters.get_filter(name)
+        print(f"filter {name} ready in {time.perf_counter() - st:.2f}s")
+
+
+class Journal(object):
+    """Append-only record of finished outputs, keyed by input path, op and input mtime."""
+    def __init__(self, path=journal_path):
+        self.path = path
+        self.done = set()
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.done.add((entry["input"], entry["op"], entry["mtime"]))
+        except OSError:
+            pass
+        self.file = open(path, "a", buffering=1)
+
+    def key(self, op, file_path):
+        return os.path.abspath(file_path), op, os.stat(file_path).st_mtime_ns
+
+    def is_done(self, op, file_path, out_path):
+        return os.path.exists(out_path) and self.key(op, file_path) in self.done
+
+    def mark(self, op, file_path):
+        key = self.key(op, file_path)
+        self.done.add(key)
+        self.file.write(json.dumps({"input": key[0], "op": op, "mtime": key[2]}) + "\n")
+
+
+def collect(patterns, folder):
+    if not patterns:
+        patterns = [folder]
+    files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            files += [os.path.join(pattern, name) for name in sorted(os.listdir(pattern))]
+        else:
+            files += sorted(glob.glob(pattern))
+    return [f for f in dict.fromkeys(files) if os.path.isfile(f)]
+
+
+def plan(files, ops, journal, force=False):
+    tasks, skipped = [], 0
+    for op in ops:
+        for file_path in files:
+            if not accepts(op, os.path.basename(file_path)):
+                continue
+            out_path = os.path.join(os.path.dirname(file_path), output_name(op, file_path))
+            if not force and journal.is_done(op, file_path, out_path):
+                skipped += 1
+                continue
+            tasks.append((op, file_path, out_path))
+    return tasks, skipped
+
+
+def run_super_night(tasks, tile, overlap, record):
+    if not tasks:
+        return
+    import torch
+    from sid_backends import load_selected
+    from sid_tiling import super_night
+    model = load_selected()
+    torch.set_num_threads(os.cpu_count() or 4)
+    for op, file_path, out_path in tasks:
+        st = time.perf_counter()
+        try:
+            super_night(model, file_path, out_path, tile=tile, overlap=overlap).result()
+            record(op, file_path, out_path, time.perf_counter() - st, True)
+        except Exception as e:
+            traceback.print_exc()
+            record(op, file_path, out_path, None, str(e))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch process captures without the GUI.")
+    parser.add_argument("paths", nargs="*", help=f"folders or globs, default {img_folder}")
+    parser.add_argument("--ops", default="vis", help="comma separated: vis, vis_hq, filter:<name>, sn")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4)
+    parser.add_argument("--force", action="store_true", help="redo outputs the journal marks as done")
+    parser.add_argument("--no-catalog", action="store_true")
+    parser.add_argument("--tile", type=int, default=512)
+    parser.add_argument("--overlap", type=int, default=32)
+    args = parser.parse_args(argv)
+
+    ops = [op.strip() for op in args.ops.split(",") if op.strip()]
+    for op in ops:
+        if op not in ("vis", "vis_hq", "sn") and not op.startswith("filter:"):
+            parser.error(f"unknown op {op}")
+    files = collect(args.paths, img_folder)
+    journal = Journal()
+    tasks, skipped = plan(files, ops, journal, args.force)
+    catalog = None if args.no_catalog else Catalog(img_folder)
+
+    stats = {}
+    failed = []
+    in_bytes = 0
+
+    def record(op, file_path, out_path, seconds, result):
+        nonlocal in_bytes
+        if seconds is None:
+            failed.append((op, file_path, result))
+            print(f"FAILED {op} {file_path}: {result}", file=sys.stderr)
+            return
+        journal.mark(op, file_path)
+        count, total = stats.get(op, (0, 0.))
+        stats[op] = (count + 1, total + seconds)
+        in_bytes += os.path.getsize(file_path)
+        if catalog is not None and os.path.dirname(os.path.abspath(out_path)) == os.path.abspath(img_folder):
+            kind = "filter" if op.startswith("filter:") else op.replace("_hq", "")
+            catalog.add(os.path.basename(out_path), kind, os.path.basename(file_path))
+        done = sum(c for c, _ in stats.values()) + len(failed)
+        print(f"[{done}/{len(tasks)}] {op} {os.path.basename(file_path)} -> {os.path.basename(out_path)} {seconds:.2f}s")
+
+    st = time.perf_counter()
+    pool_tasks = [task for task in tasks if task[0] != "sn"]
+    prebake(sorted({op.split(":", 1)[1] for op, _, _ in pool_tasks if op.startswith("filter:")}))
+    if pool_tasks:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            futures = {pool.submit(run_task, *task): task for task in pool_tasks}
+            for future in as_completed(futures):
+                op, file_path, out_path = futures[future]
+                try:
+                    record(*future.result())
+                except Exception as e:
+                    record(op, file_path, out_path, None, str(e))
+    run_super_night([task for task in tasks if task[0] == "sn"], args.tile, args.overlap, record)
+    elapsed = time.perf_counter() - st
+
+    processed = sum(c for c, _ in stats.values())
+    print(f"\n{processed} outputs in {elapsed:.1f}s, {skipped} up to date, {len(failed)} failed")
+    for op, (count, total) in sorted(stats.items()):
+        print(f"  {op:<20} {count:5d} files {total / count:7.2f}s/file (worker time)")
+    if elapsed > 0 and processed:
+        print(f"  throughput: {processed / elapsed:.2f} files/s, {in_bytes / elapsed / 1e6:.1f} MB/s input")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,54 @@
+"""Stand-in for the picamera package, so app.py can be imported off the Pi.
+
+install() registers a fake picamera, picamera.mmal, picamera.mmalobj and
+picamera.exc in sys.modules. FakeCamera returns a fixed Bayer JPEG for every
+capture.
+"""
+import sys
+import types
+
+
+class PiCameraMMALError(Exception):
+    pass
+
+
+class FakeCamera(object):
+    def __init__(self, frame):
+        self.frame = frame
+        self.iso = 0
+        self.shutter_speed = 0
+        self.exposure_mode = "auto"
+        port = types.SimpleNamespace(_port=None)
+        self._camera = types.SimpleNamespace(control=port)
+
+    def capture(self, stream, format='jpeg', bayer=False, use_video_port=False):
+        stream.write(self.frame)
+
+    def capture_sequence(self, streams, format='jpeg', bayer=False, use_video_port=False):
+        for stream in streams:
+            self.capture(stream, format, bayer, use_video_port)
+
+    def start_preview(self, **kwargs):
+        pass
+
+    def stop_preview(self,):
+        pass
+
+    def close(self,):
+        pass
+
+
+def install():
+    picamera = types.ModuleType("picamera")
+    mmal = types.ModuleType("picamera.mmal")
+    mmal.MMAL_PARAMETER_GROUP_CAMERA = 0x10000
+    mmal.mmal_port_parameter_set_rational = lambda port, param, value: 0
+    mmalobj = types.ModuleType("picamera.mmalobj")
+    mmalobj.to_rational = lambda value: value
+    exc = types.ModuleType("picamera.exc")
+    exc.PiCameraMMALError = PiCameraMMALError
+
+    picamera.PiCamera = lambda *args, **kwargs: FakeCamera(b"")
+    picamera.mmal, picamera.mmalobj, picamera.exc = mmal, mmalobj, exc
+    sys.modules.update({"picamera": picamera, "picamera.mmal": mmal,
+                        "picamera.mmalobj": mmalobj, "picamera.exc": exc})
@@ -0,0 +1,149 @@
+"""Synthetic HQ camera sized fixtures.
+
+bayer_jpeg() builds what camera.capture(..., bayer=True) returns on the HQ
+camera: a JPEG followed by the 18711040 byte Broadcom raw block holding the
+12-bit packed mosaic. write_dng() writes an uncompressed 16-bit strip DNG of
+the same mosaic, write_pidng_dng() the tiled 12-bit DNG pidng writes for the
+app's captures.
+"""
+import struct
+
+import numpy as np
+
+
+hq_size = (4056, 3040)
+black_level = 256
+white_level = 4095
+raw_rows, raw_stride = 3056, 6112
+raw_block = 18711040
+raw_header = 32768
+
+
+def scene(width=hq_size[0], height=hq_size[1], seed=0):
+    """RGB float scene in [0, 1]: gradients with some blocks, so alignment and filters have texture."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    img = np.empty((height, width, 3), np.float32)
+    img[:, :, 0] = x / width
+    img[:, :, 1] = y / height
+    img[:, :, 2] = 0.5 + 0.5 * np.sin(x / 97.) * np.cos(y / 61.)
+    for _ in range(24):
+        x0, y0 = rng.integers(0, width - 256), rng.integers(0, height - 256)
+        img[y0:y0 + 256, x0:x0 + 256] = rng.random(3)
+    return img
+
+
+def mosaic(img, seed=0, level=0.2):
+    """BGGR 12-bit mosaic of an RGB scene at a night-ish level, with shot and read noise."""
+    rng = np.random.default_rng(seed)
+    h, w = img.shape[:2]
+    out = np.empty((h, w), np.float32)
+    out[0::2, 0::2] = img[0::2, 0::2, 2]
+    out[0::2, 1::2] = img[0::2, 1::2, 1]
+    out[1::2, 0::2] = img[1::2, 0::2, 1]
+    out[1::2, 1::2] = img[1::2, 1::2, 0]
+    out = out * level * (white_level - black_level)
+    out += rng.normal(0, 1, out.shape).astype(np.float32) * (np.sqrt(out) + 4)
+    return np.clip(out + black_level, 0, white_level).astype(np.uint16)
+
+
+def pack_12(bayer):
+    """Pack a mosaic the way the Broadcom raw block stores it (two pixels in three bytes)."""
+    h, w = bayer.shape
+    out = np.empty((h, w // 2, 3), np.uint8)
+    even, odd = bayer[:, 0::2], bayer[:, 1::2]
+    out[:, :, 0] = even >> 4
+    out[:, :, 1] = odd >> 4
+    out[:, :, 2] = (even & 0x0F) | ((odd & 0x0F) << 4)
+    return out.reshape(h, -1)
+
+
+def jpeg(img, quality=90):
+    import cv2
+    ok, data = cv2.imencode(".jpg", (img[:, :, ::-1] * 255).astype(np.uint8), [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return data.tobytes()
+
+
+def bayer_jpeg(img, seed=0):
+    bayer = mosaic(img, seed)
+    block = np.zeros(raw_block, np.uint8)
+    block[:4] = np.frombuffer(b"BRCM", np.uint8)
+    data = block[raw_header:raw_header + raw_rows * raw_stride].reshape(raw_rows, raw_stride)
+    packed = pack_12(bayer)
+    data[:packed.shape[0], :packed.shape[1]] = packed
+    return jpeg(img) + block.tobytes()
+
+
+def tiff_entries(entries, offset):
+    """Pack IFD entries (tag, type, values), putting data longer than 4 bytes after the IFD at offset."""
+    formats = {1: "B", 2: "s", 3: "H", 4: "I", 5: "II", 7: "B", 10: "ii"}
+    ifd = struct.pack("<H", len(entries))
+    extra = b""
+    data_offset = offset + 2 + 12 * len(entries) + 4
+    for tag, typ, values in sorted(entries):
+        if typ == 2:
+            payload, count = values.encode() + b"\0", len(values) + 1
+            payload = struct.pack(f"<{count}s", payload)
+        else:
+            flat = [v for pair in values for v in pair] if typ in (5, 10) else list(values)
+            payload = struct.pack("<" + formats[typ][0] * len(flat), *flat)
+            count = len(values)
+        if len(payload) <= 4:
+            ifd += struct.pack("<HHI", tag, typ, count) + payload.ljust(4, b"\0")
+        else:
+            ifd += struct.pack("<HHII", tag, typ, count, data_offset + len(extra))
+            extra += payload + b"\0" * (len(payload) % 2)
+    return ifd + struct.pack("<I", 0) + extra
+
+
+def write_dng(path, bayer):
+    h, w = bayer.shape
+    data = bayer.astype("<u2").tobytes()
+    data_offset = 8
+    entries = [
+        (254, 4, [0]), (256, 4, [w]), (257, 4, [h]), (258, 3, [16]), (259, 3, [1]), (262, 3, [32803]),
+        (271, 2, "RaspberryPi"), (272, 2, "RP_imx477"), (273, 4, [data_offset]), (277, 3, [1]),
+        (278, 4, [h]), (279, 4, [len(data)]), (284, 3, [1]),
+        (33421, 3, [2, 2]), (33422, 1, [2, 1, 1, 0]),
+        (50706, 1, [1, 4, 0, 0]), (50714, 4, [black_level]), (50717, 4, [white_level]),
+        (50721, 10, [(10000, 10000), (0, 10000), (0, 10000), (0, 10000), (10000, 10000),
+                     (0, 10000), (0, 10000), (0, 10000), (10000, 10000)]),
+        (50728, 5, [(1, 2), (1, 1), (2, 3)]),
+    ]
+    ifd_offset = data_offset + len(data)
+    with open(path, "wb") as f:
+        f.write(b"II*\0" + struct.pack("<I", ifd_offset))
+        f.write(data)
+        f.write(tiff_entries(entries, ifd_offset))
+
+
+def write_pidng_dng(path, bayer):
+    """Write bayer with pidng's RAW2DNG and the HQ camera tags, returns the DNG path."""
+    import os
+    from pidng.core import RAW2DNG
+    from pidng.camdefs import RaspberryPiHqCamera
+    folder, name = os.path.split(path)
+    writer = RAW2DNG()
+    writer.options(RaspberryPiHqCamera(3).tags, folder or ".", compress=False)
+    return writer.convert(bayer.astype(np.uint16), name)
+
+
+def make_images(folder, gallery=24):
+    """Fill folder with 0.jpg (Bayer JPEG), 0.dng and plain JPEGs 1..gallery, returns the Bayer JPEG bytes.
+
+    0.dng is written by pidng when it is installed, like the app's captures.
+    """
+    import os
+    img = scene()
+    frame = bayer_jpeg(img)
+    with open(os.path.join(folder, "0.jpg"), "wb") as f:
+        f.write(frame)
+    try:
+        write_pidng_dng(os.path.join(folder, "0.dng"), mosaic(img))
+    except ImportError:
+        write_dng(os.path.join(folder, "0.dng"), mosaic(img))
+    plain = jpeg(img)
+    for i in range(1, gallery + 1):
+        with open(os.path.join(folder, f"{i}.jpg"), "wb") as f:
+            f.write(plain)
+    return frame
@@ -0,0 +1,284 @@
+"""Headless benchmarks of the app's hot paths.
+
+Runs app.py under the offscreen Qt platform with the fake picamera and
+synthetic HQ camera fixtures in a scratch directory, times each path until
+its background work has drained and prints the results as JSON. A result
+slower than its entry in thresholds.json is a regression and makes the run
+exit with status 1, as does a failed correctness check.
+
+    python benchmarks/run.py [--output results.json] [--only name ...] [--keep]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import importlib.util
+import tempfile
+import traceback
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+sys.path.insert(0, here)
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import fake_picamera
+import fixtures
+
+fake_picamera.install()
+
+
+class Skip(Exception):
+    pass
+
+
+def wait(app, predicate, timeout=300.):
+    """Run the Qt event loop until predicate() holds."""
+    end = time.perf_counter() + timeout
+    while True:
+        app.processEvents()
+        if predicate():
+            return
+        if time.perf_counter() > end:
+            raise TimeoutError("background work did not finish")
+        time.sleep(0.001)
+
+
+def stand_in_model():
+    try:
+        import torch
+    except ImportError:
+        raise Skip("torch is not installed")
+    # SID-shaped stand in (4 packed channels in, RGB at twice the size out), the real weights are not shipped
+    return torch.nn.Sequential(torch.nn.Conv2d(4, 12, 3, padding=1), torch.nn.PixelShuffle(2)).eval()
+
+
+class Bench(object):
+    def __init__(self, camera_app):
+        self.camera_app = camera_app
+        self.app = camera_app.app
+        self.menu = camera_app.menu_window
+        self.preview = camera_app.preview_window
+
+    def select(self, file_name, filter_name=None):
+        import app
+        from PyQt5 import QtGui
+        self.menu.toolButton.setText(file_name)
+        # what the gallery hands over: a QImage, null for files Qt cannot decode such as DNGs
+        img = QtGui.QImage(f"{app.img_folder}/{file_name}")
+        self.menu.selection.select(file_name, file_name, img, filter_name=filter_name)
+
+    def remove_output(self, file_name):
+        import app
+        path = f"{app.img_folder}/{file_name}"
+        if os.path.exists(path):
+            os.remove(path)
+
+    def expect_output(self, file_name):
+        """The loaders only log their exceptions, so check the file really was written."""
+        import app
+        path = f"{app.img_folder}/{file_name}"
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            raise RuntimeError(f"{file_name} was not written")
+
+    def load_images(self,):
+        model = self.menu.gallery_model
+        self.menu.load_images()
+        self.menu.gallery_view.prefetch()
+        wait(self.app, lambda: model.loader.is_idle() and not model.wanted and not model.request_timer.isActive())
+
+    def visual_filters(self,):
+        self.select("1.jpg")
+        self.menu.remove_filter_labels()
+        # previews are cached per file and filter, drop them so every run renders
+        self.menu.filter_previewer.cache.clear()
+        self.menu.visual_filters()
+        wait(self.app, self.menu.filter_loader.is_idle)
+
+    def save_filter(self,):
+        self.remove_output("1_clarendon.jpeg")
+        self.select("1.jpg", "clarendon")
+        self.menu.save_filter()
+        wait(self.app, lambda: self.menu.filter_exporter.pending() == 0)
+        self.expect_output("1_clarendon.jpeg")
+
+    def bake_filters(self,):
+        """What `python fast_filters.py bake` does once after installing."""
+        import fast_filters
+        for name in fast_filters.filter_names:
+            fast_filters.get_filter(name)
+
+    def visual_dng(self, mode):
+        if mode == "hq" and importlib.util.find_spec("rawpy") is None:
+            raise Skip("rawpy is not installed")
+        self.remove_output("0_VIS.jpeg")
+        self.select("0.dng")
+        self.menu.visual_dng(mode)
+        wait(self.app, self.menu.dng_loader.is_idle)
+        self.expect_output("0_VIS.jpeg")
+
+    def super_night(self,):
+        model = stand_in_model()
+        jobs = self.menu.night_jobs
+        jobs.model_getter = lambda: model
+        self.remove_output("0_SN.jpeg")
+        self.select("0.dng")
+        self.menu.super_night()
+        from output_writer import get_writer
+        wait(self.app, lambda: jobs.pending() == 0 and jobs.current is None and get_writer().pending() == 0)
+        self.expect_output("0_SN.jpeg")
+
+    def capture_raw(self,):
+        writer = self.preview.capture_writer
+        saved, failures = [], []
+        writer.saved.connect(lambda idx, file_path, t: saved.append(file_path))
+        writer.failed.connect(lambda idx, reason: failures.append(reason))
+        self.preview.control.failed.connect(failures.append)
+        self.preview.capture_raw()
+        # captured() reaches the window through the event loop, so wait for the writer's answer
+        wait(self.app, lambda: saved or failures)
+        if failures:
+            raise RuntimeError(failures[0])
+
+    def check_dng_layouts(self,):
+        import numpy as np
+        from raw_access import RawFrame
+        bayer = fixtures.mosaic(fixtures.scene())
+        fixtures.write_dng("strip.dng", bayer)
+        paths = ["strip.dng"]
+        try:
+            paths.append(fixtures.write_pidng_dng("pidng.dng", bayer))
+        except ImportError:
+            pass
+        for path in paths:
+            with RawFrame.open(path) as frame:
+                if not np.array_equal(frame.bayer(), bayer):
+                    raise RuntimeError(f"{path}: mosaic differs from the fixture")
+
+    def check_sid_parity(self,):
+        import numpy as np
+        import raw_access
+        try:
+            from sid_model import preprocessing
+        except ImportError:
+            raise Skip("sid_model is not installed")
+        import app
+        path = f"{app.img_folder}/0.dng"
+        ratio = raw_access.preprocessing_ratio(path)
+        reference = np.asarray(preprocessing(path), np.float32)
+        inp = raw_access.sid_input(path, ratio=ratio)
+        h, w = min(reference.shape[1], inp.shape[1]), min(reference.shape[2], inp.shape[2])
+        diff = np.abs(reference[:, :h, :w] - inp[:, :h, :w]).mean()
+        if reference.shape[0] != inp.shape[0] or diff > 0.005:
+            raise RuntimeError(f"raw_access.sid_input differs from preprocessing (ratio {ratio}, mean {diff:.4f})")
+
+    def check_night_preview(self,):
+        model = stand_in_model()
+        import app
+        from sid_tiling import sid_input, preview_inference
+        file_path = f"{app.img_folder}/0.dng"
+        img = preview_inference(model, sid_input(file_path))
+        self.menu.toolButton.setText("0.dng")
+        self.menu.night_preview(file_path, img)
+        if self.menu.MainImagelabel.pixmap() is None or self.menu.MainImagelabel.pixmap().isNull():
+            raise RuntimeError("night preview did not produce an image")
+
+    def checks(self,):
+        return [
+            ("dng_layouts", self.check_dng_layouts),
+            ("sid_parity", self.check_sid_parity),
+            ("night_preview", self.check_night_preview),
+        ]
+
+    def benchmarks(self,):
+        return [
+            ("load_images", self.load_images),
+            # cold: a fresh install without baked LUTs, previews run pilgram and the export bakes its filter
+            ("visual_filters_cold", self.visual_filters),
+            ("save_filter_cold", self.save_filter),
+            ("bake_filters", self.bake_filters),
+            ("visual_filters_warm", self.visual_filters),
+            ("save_filter_warm", self.save_filter),
+            ("visual_dng", lambda: self.visual_dng("quick")),
+            ("visual_dng_hq", lambda: self.visual_dng("hq")),
+            ("super_night", self.super_night),
+            ("capture_raw", self.capture_raw),
+        ]
+
+
+def run(only=None, keep=False):
+    with open(os.path.join(here, "thresholds.json")) as f:
+        thresholds = json.load(f)
+
+    workdir = tempfile.mkdtemp(prefix="raspy_bench_")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        os.makedirs("images")
+        st = time.perf_counter()
+        frame = fixtures.make_images("images")
+        fixture_time = time.perf_counter() - st
+
+        import app
+        camera_app = app.CameraApp(camera=fake_picamera.FakeCamera(frame))
+        camera_app.preview_window.init_ui()
+        camera_app.menu_window.init_ui()
+        camera_app.menu_window.set_widget_motion()
+        camera_app.menu_window.show_window()
+        bench = Bench(camera_app)
+
+        checks = {}
+        for name, func in bench.checks():
+            if only and name not in only:
+                continue
+            try:
+                func()
+                checks[name] = {"ok": True}
+            except Skip as e:
+                checks[name] = {"skipped": str(e)}
+            except Exception as e:
+                traceback.print_exc()
+                checks[name] = {"error": str(e), "ok": False}
+
+        results = {}
+        for name, func in bench.benchmarks():
+            if only and name not in only:
+                continue
+            result = {"threshold": thresholds.get(name)}
+            st = time.perf_counter()
+            try:
+                func()
+                result["seconds"] = round(time.perf_counter() - st, 4)
+                result["ok"] = result["threshold"] is None or result["seconds"] <= result["threshold"]
+            except Skip as e:
+                result["skipped"] = str(e)
+            except Exception as e:
+                traceback.print_exc()
+                result["error"] = str(e)
+                result["ok"] = False
+            results[name] = result
+        return {"fixtures_seconds": round(fixture_time, 3), "platform": sys.platform, "checks": checks, "results": results}
+    finally:
+        os.chdir(cwd)
+        if keep:
+            print(f"kept {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output")
+    parser.add_argument("--only", nargs="*")
+    parser.add_argument("--keep", action="store_true")
+    args = parser.parse_args()
+
+    report = run(args.only, args.keep)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    print(text)
+    entries = list(report["checks"].values()) + list(report["results"].values())
+    sys.exit(0 if all(r.get("ok", True) for r in entries) else 1)
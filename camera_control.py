@@ -0,0 +1,118 @@
+import time
+import threading
+import traceback
+from collections import deque
+
+from PyQt5 import QtCore
+from PyQt5.QtCore import pyqtSignal
+
+from instrument import instrument
+from capture_pipeline import capture_frames
+
+
+class CameraController(QtCore.QObject):
+    """Owns the PiCamera on one thread.
+
+    Parameter updates are merged while the camera is busy, so a slider drag
+    applies only the latest values. Captures and preview commands run after
+    any pending parameters, so a capture never races a reconfiguration.
+    gains maps parameter names to setter(camera, value) functions. With a
+    writer, each capture first reserves room for its frames, so the camera
+    thread waits for the writer before the next readout.
+    """
+    applied = pyqtSignal(object)
+    captured = pyqtSignal(str, object, float, float)
+    failed = pyqtSignal(str)
+    preview_started = pyqtSignal()
+
+    attributes = ("exposure_mode", "iso", "shutter_speed")
+
+    def __init__(self, camera, gains=None, writer=None):
+        super(CameraController, self).__init__()
+        self.camera = camera
+        self.gains = gains or {}
+        self.writer = writer
+        self.state = {}
+        self.params = {}
+        self.commands = deque()
+        self.busy = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def update(self, **params):
+        with self.cond:
+            self.params.update(params)
+            self.cond.notify()
+
+    def command(self, *command):
+        with self.cond:
+            self.commands.append(command)
+            self.cond.notify()
+
+    def capture(self, count, tag=""):
+        self.command("capture", count, tag)
+
+    def start_preview(self, **kwargs):
+        self.command("start_preview", kwargs)
+
+    def stop_preview(self,):
+        self.command("stop_preview")
+
+    def idle(self,):
+        with self.cond:
+            return not self.params and not self.commands and not self.busy
+
+    def apply(self, params, report=True):
+        for name in self.attributes:
+            if name in params:
+                setattr(self.camera, name, params[name])
+        for name, setter in self.gains.items():
+            if name in params:
+                setter(self.camera, params[name])
+        self.state.update(params)
+        if report:
+            self.applied.emit(dict(self.state))
+
+    def execute(self, command):
+        if command[0] == "capture":
+            _, count, tag = command
+            if self.writer is not None:
+                self.writer.reserve(count)
+            st = time.perf_counter()
+            try:
+                with instrument.span("capture"):
+                    frames = capture_frames(self.camera, count)
+            except Exception:
+                if self.writer is not None:
+                    self.writer.release(count)
+                raise
+            readout = time.perf_counter() - st
+            # the still port can leave its own settings behind
+            self.apply(self.state, report=False)
+            self.captured.emit(tag, frames, st, readout)
+        elif command[0] == "start_preview":
+            self.camera.start_preview(**command[1])
+            self.preview_started.emit()
+        elif command[0] == "stop_preview":
+            self.camera.stop_preview()
+
+    def run(self,):
+        while True:
+            with self.cond:
+                while not self.params and not self.commands:
+                    self.cond.wait()
+                params, self.params = self.params, {}
+                command = None if params or not self.commands else self.commands.popleft()
+                self.busy = True
+            try:
+                if params:
+                    self.apply(params)
+                else:
+                    self.execute(command)
+            except Exception as e:
+                traceback.print_exc()
+                self.failed.emit(str(e))
+            finally:
+                with self.cond:
+                    self.busy = False
@@ -0,0 +1,214 @@
+import io
+import os
+import time
+import tempfile
+import queue
+import threading
+import traceback
+
+from PyQt5 import QtCore
+from PyQt5.QtCore import pyqtSignal
+
+from instrument import instrument
+from output_writer import write_image
+
+
+def scratch_folder():
+    return "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+def verify_dng(dng_path, data):
+    """True when the mosaic in dng_path is identical to the raw block of the Bayer JPEG data."""
+    import numpy as np
+    from raw_access import RawFrame
+    # a copy: bayer() unpacks into a per-thread buffer the DNG side reuses
+    expected = RawFrame.from_buffer(data).bayer().copy()
+    try:
+        with RawFrame.open(dng_path) as frame:
+            return np.array_equal(frame.bayer(), expected)
+    except ValueError:
+        pass
+    try:
+        import rawpy
+    except ImportError:
+        return False
+    with rawpy.imread(dng_path) as raw:
+        return np.array_equal(raw.raw_image_visible, expected)
+
+
+def raw2dng(jpg_path, compress):
+    """pidng 4 converter: it takes an unpacked mosaic and a camera model, and only models the HQ camera."""
+    from pidng.core import RAW2DNG
+    from pidng.camdefs import RaspberryPiHqCamera
+    from pidng.defs import CFAPattern
+    from raw_access import RawFrame
+    with open(jpg_path, "rb") as f:
+        frame = RawFrame.from_buffer(f.read())
+    if (frame.width, frame.height) != (4056, 3040):
+        raise ValueError(f"pidng 4 has no camera model for {frame.width}x{frame.height} frames")
+    folder, name = os.path.split(os.path.splitext(jpg_path)[0])
+    writer = RAW2DNG()
+    writer.options(RaspberryPiHqCamera(3, getattr(CFAPattern, frame.cfa)).tags, folder or ".", compress=compress)
+    writer.convert(frame.bayer(), name)
+
+
+class CaptureWriter(QtCore.QObject):
+    """Writes captured Bayer JPEGs and converts them to DNG on a background thread.
+
+    At most max_pending frames are held between readout and write. The
+    bound is applied by reserve(), which the camera thread calls before a
+    readout and which blocks until the frames fit (a burst larger than the
+    bound waits for the writer to drain), so the shutter waits instead of
+    memory growing. submit() then never blocks the GUI thread that hands
+    the frames over; each written frame releases its slot.
+
+    storage selects what ends up in the folder:
+        "legacy"  the Bayer JPEG (JPEG + raw block) and an uncompressed DNG
+        "strip"   the JPEG without its raw block and the DNG
+        "dng"     the DNG only
+    In "strip" and "dng" the Bayer JPEG is only written to a RAM scratch
+    folder for pidng, the DNG is LJ92 compressed when pidng supports it, and
+    the full Bayer JPEG is kept in the folder next to the DNG only if the DNG
+    fails (or cannot run) verification against it. stored(idx, stats) reports the bytes written to
+    the folder and the write throughput.
+    """
+    saved = pyqtSignal(int, str, float)
+    failed = pyqtSignal(int, str)
+    stored = pyqtSignal(int, object)
+
+    def __init__(self, folder, catalog, max_pending=3, storage="strip", compress=True, scratch=None):
+        super(CaptureWriter, self).__init__()
+        self.max_pending = max_pending
+        self.held = 0
+        self.room = threading.Condition()
+        self.folder = folder
+        self.catalog = catalog
+        self.storage = storage
+        self.compress = compress
+        self.scratch = scratch or scratch_folder()
+        self.queue = queue.Queue()
+        self.dng_convert = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def reserve(self, count):
+        """Block until count more frames fit under max_pending and hold room for them."""
+        with self.room:
+            while self.held and self.held + count > self.max_pending:
+                self.room.wait()
+            self.held += count
+
+    def release(self, count=1):
+        with self.room:
+            self.held -= count
+            self.room.notify_all()
+
+    def submit(self, idx, data):
+        self.queue.put((idx, data))
+
+    def pending(self,):
+        return self.queue.qsize()
+
+    def run(self,):
+        while True:
+            idx, data = self.queue.get()
+            try:
+                self.write(idx, data)
+            except Exception as e:
+                traceback.print_exc()
+                self.failed.emit(idx, str(e))
+            finally:
+                self.queue.task_done()
+                self.release()
+
+    def convert(self, jpg_path):
+        """Convert with pidng next to jpg_path, LJ92 compressed when supported, returns the DNG path."""
+        if self.dng_convert is None:
+            from pidng.core import RPICAM2DNG
+            try:
+                converter = RPICAM2DNG()
+                self.dng_convert = lambda path, **kwargs: converter.convert(path, **kwargs)
+            except TypeError:
+                self.dng_convert = lambda path, compress=False: raw2dng(path, compress)
+        with instrument.span("dng_convert"):
+            if self.compress:
+                try:
+                    self.dng_convert(jpg_path, compress=True)
+                except Exception:
+                    # no LJ92 support (TypeError), pidng's ljpegCompress extension not built
+                    # (ImportError) or broken: write uncompressed from now on
+                    traceback.print_exc()
+                    self.compress = False
+            if not self.compress:
+                self.dng_convert(jpg_path)
+        return f"{os.path.splitext(jpg_path)[0]}.dng"
+
+    def store(self, name, data, stats):
+        st = time.perf_counter()
+        with instrument.span("capture.write"):
+            write_image(f"{self.folder}/{name}", data=data)
+        stats["seconds"] += time.perf_counter() - st
+        stats["bytes"] += len(data)
+
+    def write(self, idx, data):
+        stats = {"bytes": 0, "seconds": 0., "raw_bytes": len(data), "compressed": False, "verified": None}
+        if self.storage == "legacy":
+            file_path = f"{self.folder}/{idx}.jpg"
+            self.store(f"{idx}.jpg", data, stats)
+            self.catalog.add(f"{idx}.jpg", "capture")
+            dng_path = self.convert(file_path)
+            stats["bytes"] += os.path.getsize(dng_path)
+            self.catalog.add(f"{idx}.dng", "dng", f"{idx}.jpg")
+        else:
+            from raw_access import broadcom_block
+            file_path = f"{self.folder}/{idx}.dng"
+            if self.storage == "strip":
+                offset, _ = broadcom_block(data)
+                self.store(f"{idx}.jpg", data[:offset], stats)
+                self.catalog.add(f"{idx}.jpg", "capture")
+
+            scratch_jpg = f"{self.scratch}/raspy_{os.getpid()}_{idx}.jpg"
+            with open(scratch_jpg, "wb") as f:
+                f.write(data)
+            scratch_dng = None
+            try:
+                try:
+                    scratch_dng = self.convert(scratch_jpg)
+                except Exception:
+                    # never lose the only copy of the raw data
+                    self.store(f"{idx}.jpg", data, stats)
+                    self.catalog.add(f"{idx}.jpg", "capture")
+                    raise
+                stats["compressed"] = self.compress
+                try:
+                    stats["verified"] = verify_dng(scratch_dng, data)
+                except Exception as e:
+                    traceback.print_exc()
+                    stats["verified"] = False
+                    stats["verify_error"] = str(e)
+                with open(scratch_dng, "rb") as f:
+                    self.store(f"{idx}.dng", f.read(), stats)
+                stats["dng_bytes"] = os.path.getsize(scratch_dng)
+                if not stats["verified"]:
+                    self.store(f"{idx}.jpg", data, stats)
+                    self.catalog.add(f"{idx}.jpg", "capture")
+            finally:
+                os.remove(scratch_jpg)
+                if scratch_dng is not None and os.path.exists(scratch_dng):
+                    os.remove(scratch_dng)
+            parent = f"{idx}.jpg" if self.catalog.kind(f"{idx}.jpg") is not None else None
+            self.catalog.add(f"{idx}.dng", "dng", parent)
+        stats["mb_s"] = stats["bytes"] / max(stats["seconds"], 1e-6) / 1e6
+        self.saved.emit(idx, file_path, time.perf_counter())
+        self.stored.emit(idx, stats)
+
+
+def capture_frames(camera, count):
+    """Read count raw frames back to back into memory, returns a list of bytes."""
+    streams = [io.BytesIO() for _ in range(count)]
+    with instrument.span("capture.read"):
+        if count == 1:
+            camera.capture(streams[0], format='jpeg', bayer=True, use_video_port=False)
+        else:
+            camera.capture_sequence(streams, format='jpeg', bayer=True, use_video_port=False)
+    return [stream.getvalue() for stream in streams]
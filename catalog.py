@@ -0,0 +1,146 @@
+import os
+import sqlite3
+import threading
+
+
+catalog_path = "./.catalog.db"
+
+
+def parse_idx(name):
+    try:
+        return int(name.split(".")[0].split("_")[0])
+    except ValueError:
+        return None
+
+
+def classify(name):
+    """Guess (kind, parent) of a file from its name, used when indexing an existing folder."""
+    stem, ext = os.path.splitext(name)
+    idx = parse_idx(name)
+    suffix = stem.split("_", 1)[1] if "_" in stem else ""
+    if ext.lower() == ".dng":
+        return "dng", f"{idx}.jpg"
+    if suffix == "SN":
+        return "sn", f"{idx}.dng"
+    if suffix == "VIS":
+        return "vis", f"{idx}.dng"
+    if suffix or ext == ".JPG":
+        return "filter", None
+    if ext == ".jpg":
+        return "capture", None
+    return "file", None
+
+
+class Catalog(object):
+    """SQLite index of the images folder.
+
+    Captures and their derived outputs (DNG, VIS, SN, filter exports) are
+    stored with their capture index and parent, and a monotonic counter hands
+    out new capture indexes without listing the folder. Rows are ordered by
+    (idx, seq), seq being the insertion order.
+
+    Listeners are called as listener(event, name) with event one of
+    "inserted", "removed" or "updated", from whichever thread made the change.
+    """
+    def __init__(self, folder, path=catalog_path):
+        self.folder = folder
+        self.lock = threading.RLock()
+        self.listeners = []
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, idx INTEGER NOT NULL, "
+                        "seq INTEGER NOT NULL, kind TEXT NOT NULL, parent TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_order ON files (idx, seq)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self.db.commit()
+        if self.get_meta("counter") is None:
+            self.rescan()
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def notify(self, event, name):
+        for listener in self.listeners:
+            listener(event, name)
+
+    def get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def rescan(self,):
+        """Rebuild the catalog from a folder listing, only needed the first time or after outside edits."""
+        with self.lock:
+            names = sorted(name for name in os.listdir(self.folder)
+                           if not name.startswith(".") and parse_idx(name) is not None)
+            self.db.execute("DELETE FROM files")
+            for name in names:
+                kind, parent = classify(name)
+                if parent not in names:
+                    parent = None
+                self.insert(name, parse_idx(name), kind, parent)
+            counter = max([parse_idx(name) for name in names], default=-1) + 1
+            self.set_meta("counter", max(counter, self.get_meta("counter") or 0))
+            self.db.commit()
+
+    def insert(self, name, idx, kind, parent):
+        seq = self.get_meta("seq") or 0
+        self.set_meta("seq", seq + 1)
+        self.db.execute("INSERT OR REPLACE INTO files (name, idx, seq, kind, parent) VALUES (?, ?, ?, ?, ?)",
+                        (name, idx, seq, kind, parent))
+
+    def allocate(self,):
+        """Return a new capture index, never handed out before."""
+        with self.lock:
+            idx = self.get_meta("counter")
+            self.set_meta("counter", idx + 1)
+            self.db.commit()
+            return idx
+
+    def add(self, name, kind=None, parent=None):
+        with self.lock:
+            if kind is None:
+                kind, _ = classify(name)
+            idx = self.idx_of(parent) if parent is not None else None
+            if idx is None:
+                idx = parse_idx(name)
+            exists = self.idx_of(name) is not None
+            if exists:
+                self.db.execute("UPDATE files SET kind = ?, parent = ? WHERE name = ?", (kind, parent, name))
+            else:
+                self.insert(name, idx, kind, parent)
+            self.db.commit()
+        self.notify("updated" if exists else "inserted", name)
+
+    def remove(self, name):
+        with self.lock:
+            removed = self.db.execute("DELETE FROM files WHERE name = ?", (name,)).rowcount
+            self.db.commit()
+        if removed:
+            self.notify("removed", name)
+
+    def idx_of(self, name):
+        with self.lock:
+            row = self.db.execute("SELECT idx FROM files WHERE name = ?", (name,)).fetchone()
+            return None if row is None else row[0]
+
+    def position(self, name):
+        with self.lock:
+            row = self.db.execute("SELECT idx, seq FROM files WHERE name = ?", (name,)).fetchone()
+            return (-1, -1) if row is None else tuple(row)
+
+    def names(self,):
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT name FROM files ORDER BY idx, seq")]
+
+    def children(self, name):
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT name FROM files WHERE parent = ? ORDER BY seq", (name,))]
+
+    def kind(self, name):
+        with self.lock:
+            row = self.db.execute("SELECT kind FROM files WHERE name = ?", (name,)).fetchone()
+            return None if row is None else row[0]
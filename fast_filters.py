@@ -0,0 +1,412 @@
+"""Colour LUT versions of the pilgram filters.
+
+Each filter is baked once from pilgram into a packed 128^3 colour LUT.
+Filters with vignettes or gradients get a stack of 64^3 LUTs taken at
+increasing gradient strength instead, plus a low resolution level map that
+picks the pair to blend at each position. Applying a filter is one gather
+per pixel (two plus a blend for the spatial filters), and the filters can
+be used like pilgram itself:
+
+    img = fast_filters.clarendon(Image.open(path))
+
+Baking validates each LUT against pilgram on a test card, and apply() only
+uses it when it is accurate to min_psnr and faster than pilgram, otherwise
+pilgram runs. apply() never bakes, so the preview workers run pilgram until
+a LUT exists; get_filter() (and so export_filtered) bakes in the calling
+process. Run `python fast_filters.py bake` to bake all LUTs once ahead of
+time and `python fast_filters.py report` for accuracy and throughput.
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import Image
+
+from instrument import instrument
+from output_writer import write_image
+
+
+lut_folder = "./.filter_luts/"
+lut_bits = 7
+# filters with vignettes or gradients get levels LUTs taken at increasing gradient strength,
+# at fewer bits each to keep their size near that of one full LUT
+spatial_bits = 6
+levels = 5
+bake_canvas = (2048, 1536)
+level_size = (64, 48)
+# a baked filter is only used when it is at least this close to pilgram and faster than it
+min_psnr = 40.
+filter_names = ["_1977","aden","brannan","brooklyn","clarendon","earlybird","gingham", "hudson",
+                "inkwell","kelvin","lark","lofi","maven","mayfair","moon","nashville","perpetua",
+                "reyes","rise","slumber","stinson","toaster","valencia","walden","willow","xpro2"]
+gradient_helpers = ["radial_gradient_mask", "linear_gradient_mask", "radial_gradient", "linear_gradient"]
+
+_filters = {}
+_lock = threading.Lock()
+
+
+def identity_patch(bits=lut_bits):
+    """Return the centre colour of every LUT cell laid out in a square uint8 patch, in r, g, b index order."""
+    n, shift = 1 << bits, 8 - bits
+    values = (np.arange(n) << shift) + ((1 << shift) >> 1)
+    r, g, b = np.meshgrid(values, values, values, indexing="ij")
+    colors = np.stack([r.ravel(), g.ravel(), b.ravel()], axis=1).astype(np.uint8)
+    side = int(np.ceil(np.sqrt(len(colors))))
+    patch = np.empty((side * side, 3), np.uint8)
+    patch[:len(colors)] = colors
+    patch[len(colors):] = colors[-1]
+    return patch.reshape(side, side, 3)
+
+
+def pack(out, bits=lut_bits):
+    """Pack the filtered identity patch into a flat little endian uint32 LUT (r | g << 8 | b << 16)."""
+    lut = np.zeros((1 << (3 * bits), 4), np.uint8)
+    lut[:, :3] = np.asarray(out).reshape(-1, 3)[:len(lut)]
+    return lut.view("<u4").ravel()
+
+
+@contextmanager
+def pinned_gradients(point):
+    """Make pilgram's gradient helpers return the uniform value they take at point (x, y) of the bake canvas.
+
+    Every other pilgram step is per pixel, so filtering the identity patch
+    with pinned gradients gives the exact colour mapping at that position.
+    """
+    from pilgram import util
+    originals = {name: getattr(util, name) for name in gradient_helpers}
+
+    def pinned(func):
+        def helper(size, *args, **kwargs):
+            full = func(bake_canvas, *args, **kwargs)
+            x = min(int(point[0] * bake_canvas[0]), bake_canvas[0] - 1)
+            y = min(int(point[1] * bake_canvas[1]), bake_canvas[1] - 1)
+            return Image.new(full.mode, size, full.getpixel((x, y)))
+        return helper
+
+    try:
+        for name, func in originals.items():
+            setattr(util, name, pinned(func))
+        yield
+    finally:
+        for name, func in originals.items():
+            setattr(util, name, func)
+
+
+def bake(name):
+    """Bake pilgram filter name into (luts, level, bits).
+
+    luts holds one packed LUT, or levels of them for a filter whose output
+    depends on the position. Those are pinned where a grey frame goes
+    through evenly spaced responses, and level maps the position (at
+    level_size) to the fractional LUT index with the same response.
+    """
+    import pilgram
+    filter_func = getattr(pilgram, name)
+    width, height = bake_canvas
+
+    grey_out = np.asarray(filter_func(Image.new("RGB", bake_canvas, (128, 128, 128))), np.float32)
+    channel = int(np.argmax(grey_out.reshape(-1, 3).std(axis=0)))
+    response = grey_out[:, :, channel]
+    if response.max() - response.min() < 1.0:
+        with pinned_gradients((0.5, 0.5)):
+            return pack(filter_func(Image.fromarray(identity_patch(lut_bits))), lut_bits), None, lut_bits
+
+    patch = Image.fromarray(identity_patch(spatial_bits))
+    flat = response.ravel()
+    luts, pinned = [], []
+    for target in np.linspace(flat.min(), flat.max(), levels):
+        y, x = divmod(int(np.argmin(np.abs(flat - target))), width)
+        with pinned_gradients(((x + 0.5) / width, (y + 0.5) / height)):
+            luts.append(pack(filter_func(patch), spatial_bits))
+        pinned.append(flat[y * width + x])
+    small = np.asarray(Image.fromarray(response).resize(level_size, Image.BILINEAR), np.float32)
+    level = np.interp(small, pinned, np.arange(levels)).astype(np.float32)
+    return np.concatenate(luts), level, spatial_bits
+
+
+def lut_path(name):
+    return os.path.join(lut_folder, f"{name}.npz")
+
+
+def read_baked(name):
+    """Return the baked FastFilter for name from lut_folder, or None when it has not been baked."""
+    path = lut_path(name)
+    if not os.path.exists(path):
+        return None
+    data = np.load(path)
+    level = data["level"] if "level" in data.files else None
+    return FastFilter(name, data["luts"], level, int(data["bits"]), json.loads(str(data["stats"])))
+
+
+def save_baked(flt):
+    """Write flt to lut_folder through a unique temporary file, so processes baking the same filter don't collide."""
+    arrays = {"luts": flt.luts, "bits": flt.bits, "stats": json.dumps(flt.stats)}
+    if flt.level is not None:
+        arrays["level"] = flt.level
+    os.makedirs(lut_folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{flt.name}.", suffix=".npz", dir=lut_folder)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp_path, lut_path(flt.name))
+    except OSError:
+        # another process got its copy in place first
+        if not os.path.exists(lut_path(flt.name)):
+            raise
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def lut_index(img, bits):
+    """Packed LUT index of every pixel of an RGB uint8 image, as uint32."""
+    shift = 8 - bits
+    idx = np.right_shift(img[..., 0], shift, dtype=np.uint32)
+    idx <<= bits
+    idx |= img[..., 1] >> shift
+    idx <<= bits
+    idx |= img[..., 2] >> shift
+    return idx
+
+
+def gather(luts, idx):
+    """One gather per pixel, returns RGBX uint8."""
+    return luts.take(idx).view(np.uint8).reshape(idx.shape[0], idx.shape[1], 4)
+
+
+def sample_level(level, origin, shape, full_size):
+    """Bilinearly sample the low resolution level map over a tile of a full_size (w, h) image."""
+    gh, gw = level.shape
+    full_w, full_h = full_size
+    oy, ox = origin
+    h, w = shape
+    xs = (ox + np.arange(w, dtype=np.float32) + 0.5) * gw / full_w - 0.5
+    ys = (oy + np.arange(h, dtype=np.float32) + 0.5) * gh / full_h - 0.5
+    xs = np.clip(xs, 0, gw - 1)
+    ys = np.clip(ys, 0, gh - 1)
+    x0 = np.minimum(xs.astype(np.int32), gw - 2)
+    y0 = np.minimum(ys.astype(np.int32), gh - 2)
+    fx = np.subtract(xs, x0, dtype=np.float32)
+    fy = np.subtract(ys, y0, dtype=np.float32)[:, None]
+    rows = level[:, x0] + (level[:, x0 + 1] - level[:, x0]) * fx
+    return rows[y0] + (rows[y0 + 1] - rows[y0]) * fy
+
+
+class FastFilter(object):
+    def __init__(self, name, luts, level=None, bits=lut_bits, stats=None):
+        self.name = name
+        self.luts = luts
+        self.level = level
+        self.bits = bits
+        self.stats = stats or {}
+
+    @property
+    def usable(self,):
+        """True when validation found the LUT accurate enough and faster than pilgram."""
+        return bool(self.stats.get("psnr", 0.) >= min_psnr
+                    and self.stats.get("lut_mpix_s", 0.) > self.stats.get("pilgram_mpix_s", float("inf")))
+
+    def apply(self, img, origin=(0, 0), full_size=None):
+        """Filter an RGB uint8 array.
+
+        origin (y, x) and full_size (w, h) place a tile inside the full image,
+        so vignettes line up when an image is processed tile by tile.
+        """
+        import cv2
+        idx = lut_index(img, self.bits)
+        if self.level is None:
+            out = gather(self.luts, idx)
+        else:
+            if full_size is None:
+                full_size = (img.shape[1], img.shape[0])
+            level = sample_level(self.level, origin, img.shape[:2], full_size)
+            lower = np.minimum(level.astype(np.uint32), len(self.luts) // (1 << (3 * self.bits)) - 2)
+            weight = np.subtract(level, lower, dtype=np.float32)
+            idx += lower << np.uint32(3 * self.bits)
+            out = gather(self.luts, idx)
+            idx += np.uint32(1 << (3 * self.bits))
+            out = cv2.blendLinear(out, gather(self.luts, idx), 1. - weight, weight)
+        return cv2.cvtColor(out, cv2.COLOR_RGBA2RGB)
+
+    def __call__(self, img):
+        return Image.fromarray(self.apply(np.asarray(img.convert("RGB"))))
+
+
+def compare(out, ref):
+    err = np.abs(out.astype(np.float32) - ref)
+    mse = float(np.mean(err ** 2))
+    psnr = float("inf") if mse == 0 else 10 * np.log10(255. ** 2 / mse)
+    return psnr, float(err.mean()), float(err.max())
+
+
+def validate(flt, img=None, repeat=3):
+    """Accuracy and speed of flt against pilgram on img (the test card by default)."""
+    import pilgram
+    img = test_image() if img is None else img
+    pil_img = Image.fromarray(img)
+    mpix = img.shape[0] * img.shape[1] / 1e6
+
+    st = time.perf_counter()
+    for _ in range(repeat):
+        out = flt.apply(img)
+    lut_time = (time.perf_counter() - st) / repeat
+
+    st = time.perf_counter()
+    for _ in range(repeat):
+        ref = getattr(pilgram, flt.name)(pil_img)
+    pilgram_time = (time.perf_counter() - st) / repeat
+
+    psnr, mean_abs, max_abs = compare(out, np.asarray(ref, np.float32))
+    return {"psnr": min(psnr, 99.), "mean_abs": mean_abs, "max_abs": max_abs,
+            "lut_mpix_s": mpix / lut_time, "pilgram_mpix_s": mpix / pilgram_time}
+
+
+def apply_pilgram(name, img):
+    import pilgram
+    return np.asarray(getattr(pilgram, name)(Image.fromarray(img)))
+
+
+def load(name):
+    """Return the baked filter name, or None when it has not been baked yet. Never bakes."""
+    if name not in filter_names:
+        raise AttributeError(f"unknown filter {name}")
+    with _lock:
+        if name not in _filters:
+            flt = read_baked(name)
+            if flt is None:
+                return None
+            _filters[name] = flt
+        return _filters[name]
+
+
+def get_filter(name):
+    """Return filter name, baking and validating it in this process first if needed."""
+    flt = load(name)
+    if flt is not None:
+        return flt
+    flt = FastFilter(name, *bake(name))
+    flt.stats = validate(flt)
+    save_baked(flt)
+    with _lock:
+        return _filters.setdefault(name, flt)
+
+
+def apply(name, img, origin=(0, 0), full_size=None):
+    """Filter an RGB uint8 array.
+
+    The baked LUT is used when it is usable, otherwise pilgram runs (whole
+    images only). This never bakes, so pool workers don't each bake the same
+    filters: get_filter() or `python fast_filters.py bake` does that once.
+    """
+    flt = load(name)
+    if flt is not None and flt.usable:
+        return flt.apply(img, origin, full_size)
+    if full_size is not None and tuple(full_size) != (img.shape[1], img.shape[0]):
+        raise ValueError(f"{name} runs through pilgram, which cannot filter a tile")
+    return apply_pilgram(name, img)
+
+
+def filter_strip(name, strip, origin, full_size):
+    """Filter one BGR strip of a full_size (w, h) image, origin (y, x) being its top left corner."""
+    import cv2
+    rgb = cv2.cvtColor(strip, cv2.COLOR_BGR2RGB)
+    out = apply(name, rgb, origin, full_size)
+    return cv2.cvtColor(out, cv2.COLOR_RGB2BGR, dst=rgb)
+
+
+def export_filtered(file_path, out_path, name, pool, strip_rows=256, in_flight=8, progress=None):
+    """Apply filter name to file_path at full resolution and write out_path.
+
+    The image is cut into full width strips that are filtered on the process
+    pool, at most in_flight at a time, and written back in place into the
+    decoded buffer, so memory stays at one image plus the strips in flight.
+    Each strip is placed in the full frame through origin/full_size, so the
+    vignette and gradient weights are continuous across strip borders.
+    The filter is baked here first if needed, so the workers only load it.
+    Filters without a usable LUT go through pilgram as one whole image task.
+    progress(done, total) is called as strips complete.
+    """
+    import cv2
+    with instrument.span("filter_save.decode"):
+        img = cv2.imread(file_path)
+    if img is None:
+        raise ValueError(f"could not read {file_path}")
+    h, w = img.shape[:2]
+    starts = list(range(0, h, strip_rows)) if get_filter(name).usable else [0]
+    strip_rows = strip_rows if len(starts) > 1 else h
+
+    with instrument.span("filter_save.compute"):
+        pending = deque()
+        done = 0
+        for y in starts + [None]:
+            if y is not None:
+                pending.append((y, pool.submit(filter_strip, name, img[y:y + strip_rows], (y, 0), (w, h))))
+                if len(pending) < in_flight:
+                    continue
+            while pending and (y is None or len(pending) >= in_flight):
+                y0, future = pending.popleft()
+                strip = future.result()
+                img[y0:y0 + strip.shape[0]] = strip
+                done += 1
+                if progress is not None:
+                    progress(done, len(starts))
+
+    with instrument.span("filter_save.write"):
+        write_image(out_path, img)
+
+
+def __getattr__(name):
+    if name in filter_names:
+        return get_filter(name)
+    raise AttributeError(f"module {__name__} has no attribute {name}")
+
+
+def test_image(size=(1014, 760)):
+    """Synthetic RGB test card: smooth colour ramps plus texture."""
+    w, h = size
+    x = np.linspace(0, 1, w, dtype=np.float32)[None, :]
+    y = np.linspace(0, 1, h, dtype=np.float32)[:, None]
+    rng = np.random.default_rng(0)
+    img = np.stack([x * np.ones_like(y), y * np.ones_like(x), (1 - x) * y], axis=-1)
+    img = img * 230 + rng.normal(0, 12, (h, w, 3))
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def report(image_path=None, repeat=3):
+    """Compare every filter against pilgram and time both, returns a list of dict rows."""
+    img = None if image_path is None else np.asarray(Image.open(image_path).convert("RGB"))
+    rows = []
+    for name in filter_names:
+        fast = get_filter(name)
+        row = validate(fast, img, repeat)
+        row.update(filter=name, spatial=fast.level is not None, usable=fast.usable)
+        rows.append(row)
+    return rows
+
+
+def main(argv):
+    if len(argv) > 1 and argv[1] == "bake":
+        for name in filter_names:
+            st = time.perf_counter()
+            get_filter(name)
+            print(f"{name:>10}: {time.perf_counter() - st:.2f} s")
+    elif len(argv) > 1 and argv[1] == "report":
+        rows = report(argv[2] if len(argv) > 2 else None)
+        print(f"{'filter':>10} {'PSNR':>7} {'mean':>6} {'max':>5} {'LUT MP/s':>9} {'pilgram MP/s':>13} used")
+        for row in rows:
+            print(f"{row['filter']:>10} {row['psnr']:7.2f} {row['mean_abs']:6.2f} {row['max_abs']:5.0f} "
+                  f"{row['lut_mpix_s']:9.2f} {row['pilgram_mpix_s']:13.2f} {'yes' if row['usable'] else 'no'}")
+        with open("filter_report.json", "w") as f:
+            json.dump(rows, f, indent=1)
+    else:
+        print("usage: python fast_filters.py bake | report [image]")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
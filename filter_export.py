@@ -0,0 +1,45 @@
+import queue
+import threading
+import traceback
+
+from PyQt5 import QtCore
+from PyQt5.QtCore import pyqtSignal
+
+from instrument import instrument
+
+
+class FilterExporter(QtCore.QObject):
+    """Runs full resolution filter exports one at a time off the GUI thread."""
+    progress = pyqtSignal(str, float)
+    finished = pyqtSignal(str, str)
+    failed = pyqtSignal(str, str)
+
+    def __init__(self, pool_getter, strip_rows=256):
+        super(FilterExporter, self).__init__()
+        self.pool_getter = pool_getter
+        self.strip_rows = strip_rows
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, file_path, out_path, name):
+        self.queue.put((file_path, out_path, name))
+
+    def pending(self,):
+        return self.queue.unfinished_tasks
+
+    def run(self,):
+        while True:
+            file_path, out_path, name = self.queue.get()
+            try:
+                # imported on the first export, numpy and PIL stay out of app start up
+                from fast_filters import export_filtered
+                with instrument.span("filter_save"):
+                    export_filtered(file_path, out_path, name, self.pool_getter(), self.strip_rows,
+                                    progress=lambda done, total: self.progress.emit(out_path, done / total))
+                self.finished.emit(file_path, out_path)
+            except Exception as e:
+                traceback.print_exc()
+                self.failed.emit(out_path, str(e))
+            finally:
+                self.queue.task_done()
@@ -0,0 +1,90 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from instrument import instrument
+
+
+preview_size = (320, 240)
+
+
+def apply_filter(name, img):
+    """Apply a filter by name to an RGB uint8 array and return an RGB uint8 array."""
+    import fast_filters
+    return fast_filters.apply(name, img)
+
+
+def decode_preview_source(file_path):
+    """Decode file_path once at preview resolution as RGB.
+
+    IMREAD_REDUCED_COLOR_4 lets libjpeg decode at a quarter scale, which is
+    still larger than the 320x240 preview for every capture size.
+    """
+    import cv2
+    img = cv2.imread(file_path, cv2.IMREAD_REDUCED_COLOR_4)
+    if img is None:
+        img = cv2.imread(file_path)
+    if img is None:
+        return None
+    img = cv2.resize(img, preview_size, interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+class FilterPreviewer(object):
+    """Renders filter previews on a process pool, decoding each source image only once.
+
+    Results are cached per (file, mtime, filter) so reopening the filter view
+    on the same photo does not run any filter again.
+    """
+    def __init__(self, workers=4, cache_limit=4 * 26, source_limit=4):
+        self.workers = workers
+        self.cache_limit = cache_limit
+        self.source_limit = source_limit
+        self.pool = None
+        self.lock = threading.Lock()
+        self.sources = OrderedDict()
+        self.cache = OrderedDict()
+
+    def get_pool(self,):
+        with self.lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self.pool
+
+    def source(self, file_path, mtime):
+        key = (file_path, mtime)
+        with self.lock:
+            if key not in self.sources:
+                self.sources[key] = decode_preview_source(file_path)
+                while len(self.sources) > self.source_limit:
+                    self.sources.popitem(last=False)
+            self.sources.move_to_end(key)
+            return self.sources[key]
+
+    def render(self, file_path, name):
+        """Return the filtered 320x240 RGB preview of file_path, or None if it can't be decoded."""
+        mtime = os.stat(file_path).st_mtime_ns
+        key = (file_path, mtime, name)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+
+        with instrument.span("filter_preview"):
+            with instrument.span("filter_preview.decode"):
+                img = self.source(file_path, mtime)
+            if img is None:
+                return None
+            with instrument.span("filter_preview.compute"):
+                img = self.get_pool().submit(apply_filter, name, img).result()
+
+        with self.lock:
+            self.cache[key] = img
+            while len(self.cache) > self.cache_limit:
+                self.cache.popitem(last=False)
+        return img
+
+    def shutdown(self,):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
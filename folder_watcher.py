@@ -0,0 +1,43 @@
+import os
+from PyQt5 import QtCore
+from PyQt5.QtCore import pyqtSlot, pyqtSignal
+
+from catalog import parse_idx
+
+
+class CatalogWatcher(QtCore.QObject):
+    """Turns catalog changes into GUI thread signals and keeps the catalog in sync with the folder.
+
+    Changes made through the catalog are forwarded as they happen. Files
+    added or removed behind the app's back are picked up by a debounced
+    QFileSystemWatcher on the folder.
+    """
+    inserted = pyqtSignal(str)
+    removed = pyqtSignal(str)
+    updated = pyqtSignal(str)
+
+    def __init__(self, catalog, folder, debounce_ms=500):
+        super(CatalogWatcher, self).__init__()
+        self.catalog = catalog
+        self.folder = folder
+        catalog.add_listener(self.catalog_changed)
+
+        self.sync_timer = QtCore.QTimer()
+        self.sync_timer.setSingleShot(True)
+        self.sync_timer.setInterval(debounce_ms)
+        self.sync_timer.timeout.connect(self.sync)
+        self.fs_watcher = QtCore.QFileSystemWatcher([folder])
+        self.fs_watcher.directoryChanged.connect(self.sync_timer.start)
+
+    def catalog_changed(self, event, name):
+        getattr(self, event).emit(name)
+
+    @pyqtSlot()
+    def sync(self,):
+        on_disk = {name for name in os.listdir(self.folder)
+                   if not name.startswith(".") and parse_idx(name) is not None}
+        known = set(self.catalog.names())
+        for name in sorted(on_disk - known):
+            self.catalog.add(name)
+        for name in known - on_disk:
+            self.catalog.remove(name)
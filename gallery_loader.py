@@ -0,0 +1,90 @@
+import traceback
+from PyQt5 import QtCore
+from PyQt5.QtCore import QThreadPool, QRunnable, pyqtSlot, pyqtSignal
+
+
+class LoadSignals(QtCore.QObject):
+    done = pyqtSignal(int, int, object)
+
+
+class LoadTask(QRunnable):
+    def __init__(self, loader, generation, position, func, args):
+        super(LoadTask, self).__init__()
+        self.loader = loader
+        self.generation = generation
+        self.position = position
+        self.func = func
+        self.args = args
+
+    def run(self,):
+        if self.loader.generation != self.generation:
+            return
+        try:
+            result = self.func(*self.args)
+        except Exception:
+            traceback.print_exc()
+            result = None
+        self.loader.signals.done.emit(self.generation, self.position, result)
+
+
+class OrderedLoader(QtCore.QObject):
+    """Runs jobs on a private QThreadPool and re-emits their results in submission order.
+
+    ready(position, result) is always delivered on the GUI thread, so the
+    receiver can build widgets directly. cancel() drops queued jobs and
+    discards results of jobs that are already running.
+    """
+    ready = pyqtSignal(int, object)
+    finished = pyqtSignal()
+
+    def __init__(self, max_threads=None):
+        super(OrderedLoader, self).__init__()
+        self.pool = QThreadPool()
+        if max_threads is not None:
+            self.pool.setMaxThreadCount(max_threads)
+        self.signals = LoadSignals()
+        self.signals.done.connect(self.collect)
+        self.generation = 0
+        self.pending = {}
+        self.next_position = 0
+        self.end_position = 0
+        self.outstanding = 0
+
+    def is_idle(self,):
+        return self.outstanding == 0
+
+    def submit(self, func, args_list, start=None):
+        if start is None:
+            start = 0 if self.is_idle() else self.end_position
+        if self.is_idle():
+            self.next_position = start
+        for i, args in enumerate(args_list, start):
+            self.outstanding += 1
+            self.pool.start(LoadTask(self, self.generation, i, func, args))
+            self.end_position = i + 1
+        if self.is_idle():
+            self.finished.emit()
+
+    def cancel(self,):
+        """Drop all queued work, return True if anything was still outstanding."""
+        was_busy = not self.is_idle()
+        self.generation += 1
+        self.pool.clear()
+        self.pending.clear()
+        self.outstanding = 0
+        return was_busy
+
+    @pyqtSlot(int, int, object)
+    def collect(self, generation, position, result):
+        if generation != self.generation:
+            return
+        self.pending[position] = result
+        while self.next_position in self.pending:
+            result = self.pending.pop(self.next_position)
+            self.outstanding -= 1
+            self.ready.emit(self.next_position, result)
+            if generation != self.generation:
+                return
+            self.next_position += 1
+        if self.is_idle():
+            self.finished.emit()
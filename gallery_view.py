@@ -0,0 +1,218 @@
+from bisect import bisect_right
+from collections import OrderedDict
+from pathlib import Path
+from PyQt5 import QtCore, QtGui, QtWidgets
+from PyQt5.QtCore import pyqtSlot
+
+from gallery_loader import OrderedLoader
+from instrument import instrument
+
+
+class GalleryModel(QtCore.QAbstractListModel):
+    """List model over the gallery files that only holds images for rows the view asks for.
+
+    Strip thumbnails and 320x240 previews live in two bounded LRU pools, so
+    memory stays flat no matter how many files are listed.
+    """
+    def __init__(self, thumb_cache, sort_key=None, thumb_limit=256, preview_limit=32):
+        super(GalleryModel, self).__init__()
+        self.thumb_cache = thumb_cache
+        self.sort_key = sort_key
+        self.thumb_limit = thumb_limit
+        self.preview_limit = preview_limit
+        self.files = []
+        self.keys = []
+        self.rows = {}
+        self.thumbs = OrderedDict()
+        self.previews = OrderedDict()
+        self.requested = set()
+        self.wanted = []
+        self.placeholder = QtGui.QPixmap(75, 75)
+        self.placeholder.fill(QtCore.Qt.black)
+
+        self.loader = OrderedLoader()
+        self.loader.ready.connect(self.image_loaded)
+        self.loader.finished.connect(self.thumb_cache.flush)
+        self.request_timer = QtCore.QTimer()
+        self.request_timer.setSingleShot(True)
+        self.request_timer.timeout.connect(self.submit_requests)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.files)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        file = self.files[index.row()]
+        if role == QtCore.Qt.DisplayRole:
+            return Path(file).name
+        if role == QtCore.Qt.DecorationRole:
+            pixmap = self.thumbs.get(file)
+            if pixmap is None:
+                self.request(file)
+                return self.placeholder
+            self.thumbs.move_to_end(file)
+            return pixmap
+        return None
+
+    def file_name(self, row):
+        return Path(self.files[row]).name
+
+    def set_files(self, files):
+        self.cancel()
+        self.beginResetModel()
+        self.files = list(files)
+        self.keys = [self.key(file) for file in self.files]
+        self.rows = {file: row for row, file in enumerate(self.files)}
+        for pool in (self.thumbs, self.previews):
+            for file in [file for file in pool if file not in self.rows]:
+                del pool[file]
+        self.endResetModel()
+
+    def append_files(self, files):
+        if not files:
+            return
+        st = len(self.files)
+        self.beginInsertRows(QtCore.QModelIndex(), st, st + len(files) - 1)
+        for row, file in enumerate(files, st):
+            self.files.append(file)
+            self.keys.append(self.key(file))
+            self.rows[file] = row
+        self.endInsertRows()
+
+    def key(self, file):
+        return self.sort_key(file) if self.sort_key is not None else 0
+
+    def remove_file(self, file):
+        row = self.rows.pop(file, None)
+        if row is None:
+            return
+        self.beginRemoveRows(QtCore.QModelIndex(), row, row)
+        del self.files[row]
+        del self.keys[row]
+        for i in range(row, len(self.files)):
+            self.rows[self.files[i]] = i
+        self.thumbs.pop(file, None)
+        self.previews.pop(file, None)
+        self.requested.discard(file)
+        self.endRemoveRows()
+
+    def insert_file(self, file):
+        """Insert a single file at its sorted position without resetting the model."""
+        if file in self.rows:
+            self.thumbs.pop(file, None)
+            self.previews.pop(file, None)
+            index = self.index(self.rows[file])
+            self.dataChanged.emit(index, index)
+            return
+        key = self.key(file)
+        row = bisect_right(self.keys, key)
+        self.beginInsertRows(QtCore.QModelIndex(), row, row)
+        self.files.insert(row, file)
+        self.keys.insert(row, key)
+        for i in range(row, len(self.files)):
+            self.rows[self.files[i]] = i
+        self.endInsertRows()
+
+    def request(self, file):
+        if file in self.requested:
+            return
+        self.requested.add(file)
+        self.wanted.append(file)
+        self.request_timer.start(0)
+
+    def prefetch(self, first, last):
+        self.cancel()
+        first = max(first, 0)
+        last = min(last, len(self.files) - 1)
+        for row in range(first, last + 1):
+            file = self.files[row]
+            if file not in self.thumbs:
+                self.request(file)
+
+    @pyqtSlot()
+    def submit_requests(self,):
+        wanted, self.wanted = self.wanted, []
+        self.loader.submit(self.load, [(file,) for file in wanted])
+
+    def load(self, file):
+        with instrument.span("gallery_load"):
+            small, large = self.thumb_cache.load(file)
+        return file, small, large
+
+    def cancel(self,):
+        self.loader.cancel()
+        self.request_timer.stop()
+        self.requested.clear()
+        self.wanted = []
+
+    @pyqtSlot(int, object)
+    def image_loaded(self, position, result):
+        if result is None:
+            return
+        file, small, large = result
+        self.requested.discard(file)
+        row = self.rows.get(file)
+        if row is None:
+            return
+        self.thumbs[file] = QtGui.QPixmap.fromImage(small)
+        self.put_preview(file, large)
+        while len(self.thumbs) > self.thumb_limit:
+            self.thumbs.popitem(last=False)
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [QtCore.Qt.DecorationRole])
+
+    def put_preview(self, file, img):
+        self.previews[file] = img
+        self.previews.move_to_end(file)
+        while len(self.previews) > self.preview_limit:
+            self.previews.popitem(last=False)
+
+    def preview(self, row):
+        file = self.files[row]
+        img = self.previews.get(file)
+        if img is None:
+            _, img = self.thumb_cache.load(file)
+            self.put_preview(file, img)
+        else:
+            self.previews.move_to_end(file)
+        return img
+
+
+class GalleryView(QtWidgets.QListView):
+    """Horizontal thumbnail strip that prefetches a margin of rows around the visible window."""
+    def __init__(self, parent=None, prefetch_margin=8):
+        super(GalleryView, self).__init__(parent)
+        self.prefetch_margin = prefetch_margin
+        self.setViewMode(QtWidgets.QListView.IconMode)
+        self.setFlow(QtWidgets.QListView.LeftToRight)
+        self.setWrapping(False)
+        self.setMovement(QtWidgets.QListView.Static)
+        self.setResizeMode(QtWidgets.QListView.Adjust)
+        self.setUniformItemSizes(True)
+        self.setIconSize(QtCore.QSize(75, 75))
+        self.setGridSize(QtCore.QSize(85, 95))
+        self.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
+        self.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.horizontalScrollBar().valueChanged.connect(self.prefetch)
+
+    def visible_rows(self,):
+        rect = self.viewport().rect()
+        first = self.indexAt(rect.topLeft() + QtCore.QPoint(1, 1))
+        last = self.indexAt(rect.topRight() + QtCore.QPoint(-1, 1))
+        first = first.row() if first.isValid() else 0
+        last = last.row() if last.isValid() else self.model().rowCount() - 1
+        return first, last
+
+    @pyqtSlot()
+    def prefetch(self,):
+        if self.model() is None:
+            return
+        first, last = self.visible_rows()
+        self.model().prefetch(first - self.prefetch_margin, last + self.prefetch_margin)
+
+    def resizeEvent(self, event):
+        super(GalleryView, self).resizeEvent(event)
+        self.prefetch()
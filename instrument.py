@@ -0,0 +1,144 @@
+"""Timing spans for the user facing operations.
+
+Enabled with `python app.py --instrument` or RASPY_INSTRUMENT=1. Code wraps
+an operation and its stages in spans:
+
+    with instrument.span("filter_save"):
+        with instrument.span("filter_save.decode"):
+            ...
+
+Spans are kept in rolling windows per name (latency percentiles and a log
+scale histogram) together with the resident memory sampled when each span
+starts and ends, and each finished span is appended to a JSON-lines log. When disabled, span() returns
+a shared no-op context manager.
+"""
+import os
+import sys
+import json
+import time
+import threading
+from collections import deque
+
+
+log_path = "./instrument.jsonl"
+# histogram bucket upper bounds in seconds
+buckets = (0.001, 0.003, 0.01, 0.03, 0.1, 0.3, 1., 3., 10., 30., 100., float("inf"))
+
+
+def max_rss():
+    """Lifetime peak resident set size of the process in MB."""
+    try:
+        import resource
+    except ImportError:
+        return 0.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1 << 20) if sys.platform == "darwin" else rss / 1024.
+
+
+def current_rss():
+    """Resident set size of the process right now in MB, the lifetime peak where /proc is missing."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return max_rss()
+    return pages * os.sysconf("SC_PAGE_SIZE") / (1 << 20)
+
+
+class NullSpan(object):
+    def __enter__(self,):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class Span(object):
+    def __init__(self, instrument, name):
+        self.instrument = instrument
+        self.name = name
+
+    def __enter__(self,):
+        self.rss = current_rss()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.instrument.record(self.name, time.perf_counter() - self.start, self.rss, current_rss())
+        return False
+
+
+class Instrument(object):
+    def __init__(self, enabled, path=log_path, window=256):
+        self.enabled = enabled
+        self.path = path
+        self.window = window
+        self.null = NullSpan()
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.peaks = {}
+        self.last_op = None
+        self.version = 0
+        self.log = None
+
+    def span(self, name):
+        if not self.enabled:
+            return self.null
+        return Span(self, name)
+
+    def record(self, name, seconds, rss_start, rss_end):
+        """Add a finished span, rss_start and rss_end being the resident memory in MB when it started and ended."""
+        entry = {"t": round(time.time(), 3), "name": name, "seconds": round(seconds, 6),
+                 "thread": threading.current_thread().name, "rss_mb": round(rss_end, 1),
+                 "rss_delta_mb": round(rss_end - rss_start, 1)}
+        with self.lock:
+            self.samples.setdefault(name, deque(maxlen=self.window)).append(seconds)
+            self.peaks[name] = max(self.peaks.get(name, 0.), rss_start, rss_end)
+            if "." not in name:
+                self.last_op = name
+                self.version += 1
+            if self.log is None:
+                self.log = open(self.path, "a", buffering=1)
+            self.log.write(json.dumps(entry) + "\n")
+
+    def stats(self, name):
+        """Rolling count, p50, p90, p99 and max in seconds, histogram counts per bucket and the highest RSS sampled in the spans."""
+        with self.lock:
+            samples = sorted(self.samples.get(name, ()))
+            peak = self.peaks.get(name, 0.)
+        if not samples:
+            return None
+        pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+        histogram = [0] * len(buckets)
+        i = 0
+        for s in samples:
+            while s > buckets[i]:
+                i += 1
+            histogram[i] += 1
+        return {"count": len(samples), "p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99),
+                "max": samples[-1], "histogram": histogram, "peak_rss_mb": peak}
+
+    def summary(self, name):
+        """One line for the status bar: last duration, its stages, rolling p50/p90 and peak memory."""
+        stats = self.stats(name)
+        if stats is None:
+            return ""
+        with self.lock:
+            last = self.samples[name][-1]
+            stages = [(stage.split(".", 1)[1], self.samples[stage][-1]) for stage in self.samples
+                      if stage.startswith(name + ".")]
+        parts = " ".join(f"{stage} {t:.2f}" for stage, t in stages)
+        return (f"{name} {last:.2f}s ({parts}) p50 {stats['p50']:.2f} p90 {stats['p90']:.2f} "
+                f"n={stats['count']} peak {stats['peak_rss_mb']:.0f} MB")
+
+    def report(self, file=sys.stderr):
+        with self.lock:
+            names = sorted(self.samples)
+        for name in names:
+            stats = self.stats(name)
+            print(f"{name:<24} n={stats['count']:<4} p50 {stats['p50'] * 1000:9.1f} ms "
+                  f"p90 {stats['p90'] * 1000:9.1f} ms max {stats['max'] * 1000:9.1f} ms "
+                  f"peak {stats['peak_rss_mb']:.0f} MB", file=file)
+
+
+instrument = Instrument(os.environ.get("RASPY_INSTRUMENT") == "1" or "--instrument" in sys.argv)
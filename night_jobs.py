@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import threading
+import traceback
+from pathlib import Path
+
+from PyQt5 import QtCore
+from PyQt5.QtCore import pyqtSignal
+
+
+queue_path = "./.sn_queue.json"
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def night_output_path(file_path):
+    return f"{os.path.dirname(file_path)}/{Path(file_path).stem}_SN.jpeg"
+
+
+class NightJobQueue(QtCore.QObject):
+    """Background Super Night worker.
+
+    DNG paths are processed one at a time on a worker thread with the torch
+    thread count saved with the SID backend, or num_threads without one. The pending list is persisted to queue_path after
+    every change, so an interrupted batch resumes on the next start. A job
+    stays in the persisted list until its output is written, and is queued
+    again once if the write fails.
+    """
+    progress = pyqtSignal(str, float, int)
+    finished = pyqtSignal(str, str)
+    failed = pyqtSignal(str, str)
+    stacked = pyqtSignal(str, object)
+    preview = pyqtSignal(str, object)
+
+    def __init__(self, model_getter, path=queue_path, num_threads=3, tile=512, overlap=32, progressive=True):
+        super(NightJobQueue, self).__init__()
+        self.model_getter = model_getter
+        self.path = path
+        self.num_threads = num_threads
+        self.tile = tile
+        self.overlap = overlap
+        self.progressive = progressive
+        self.jobs = []
+        self.stacks = {}
+        self.writing = set()
+        self.requeued = set()
+        self.current = None
+        self.cancel_current = False
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def start(self,):
+        try:
+            with open(self.path) as f:
+                self.jobs = [job for job in json.load(f) if os.path.exists(job)]
+        except (OSError, ValueError):
+            self.jobs = []
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def persist(self,):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            pending = self.jobs + sorted(job for job in self.writing if job not in self.jobs)
+            json.dump([job for job in pending if job not in self.stacks], f)
+        os.replace(tmp_path, self.path)
+
+    def pending(self,):
+        with self.cond:
+            return len(self.jobs)
+
+    def submit(self, file_paths):
+        with self.cond:
+            for file_path in file_paths:
+                if file_path not in self.jobs:
+                    self.jobs.append(file_path)
+            self.persist()
+            self.cond.notify()
+
+    def submit_stack(self, file_path, frames, use_sid=True):
+        """Queue an in-memory burst for night stacking, file_path being the saved reference capture.
+
+        Stacks are not persisted: the raw frames only exist in memory.
+        """
+        with self.cond:
+            self.stacks[file_path] = (frames, use_sid)
+            self.jobs.append(file_path)
+            self.cond.notify()
+
+    def cancel(self, file_path=None):
+        """Cancel one job, or the running job and everything queued when file_path is None."""
+        with self.cond:
+            if file_path is None:
+                self.jobs = [self.current] if self.current is not None else []
+                self.cancel_current = self.current is not None
+            elif file_path == self.current:
+                self.cancel_current = True
+            elif file_path in self.jobs:
+                self.jobs.remove(file_path)
+            self.stacks = {job: stack for job, stack in self.stacks.items() if job in self.jobs}
+            self.persist()
+
+    def check_progress(self, file_path, done, total):
+        with self.cond:
+            if self.cancel_current:
+                raise JobCancelled()
+            queued = len(self.jobs) - 1
+        self.progress.emit(file_path, done / total, queued)
+
+    def run(self,):
+        while True:
+            with self.cond:
+                while not self.jobs:
+                    self.cond.wait()
+                self.current = self.jobs[0]
+                self.cancel_current = False
+            file_path = self.current
+
+            written = None
+            try:
+                if file_path in self.stacks:
+                    self.process_stack(file_path, *self.stacks[file_path])
+                else:
+                    written = self.process(file_path)
+            except JobCancelled:
+                self.failed.emit(file_path, "cancelled")
+            except Exception as e:
+                traceback.print_exc()
+                self.failed.emit(file_path, str(e))
+
+            with self.cond:
+                if file_path in self.jobs:
+                    self.jobs.remove(file_path)
+                if written is not None:
+                    # persisted until the output is in place
+                    self.writing.add(file_path)
+                self.stacks.pop(file_path, None)
+                self.current = None
+                self.persist()
+            if written is not None:
+                written.add_done_callback(lambda future, file_path=file_path: self.written(file_path, future))
+
+    def threads(self,):
+        """The thread count saved with the benchmarked SID backend, num_threads when none was picked."""
+        from sid_backends import backend_path
+        try:
+            with open(backend_path) as f:
+                return json.load(f).get("threads") or self.num_threads
+        except (OSError, ValueError):
+            return self.num_threads
+
+    def process(self, file_path):
+        """Render file_path, returns the output writer future."""
+        import torch
+        torch.set_num_threads(self.threads())
+        from sid_tiling import super_night
+        out_path = night_output_path(file_path)
+        preview = (lambda img: self.preview.emit(file_path, img)) if self.progressive else None
+        return super_night(self.model_getter(), file_path, out_path, tile=self.tile, overlap=self.overlap,
+                           progress=lambda done, total: self.check_progress(file_path, done, total), preview=preview)
+
+    def written(self, file_path, future):
+        error = future.exception()
+        with self.cond:
+            self.writing.discard(file_path)
+            requeue = error is not None and file_path not in self.requeued and file_path not in self.jobs
+            if requeue:
+                self.requeued.add(file_path)
+                self.jobs.append(file_path)
+                self.cond.notify()
+            else:
+                self.requeued.discard(file_path)
+            self.persist()
+        if error is None:
+            self.finished.emit(file_path, future.result())
+        else:
+            self.failed.emit(file_path, f"{error}{', queued again' if requeue else ''}")
+
+    def process_stack(self, file_path, frames, use_sid):
+        import numpy as np
+        from output_writer import write_image
+        from night_stack import stack_frames, render_planes
+        self.check_progress(file_path, 0, 1)
+        merged, raw, timings = stack_frames(frames, progress=lambda done, total: self.check_progress(
+            file_path, 0.5 * done / total if use_sid else done / total, 1))
+
+        st = time.perf_counter()
+        if use_sid:
+            import torch
+            import raw_access
+            torch.set_num_threads(self.threads())
+            from sid_tiling import tiled_inference
+            ratio = raw_access.preprocessing_ratio(file_path) if os.path.exists(file_path) else None
+            inp = np.minimum(merged * (raw_access.sid_ratio if ratio is None else ratio), 1.0)
+            out = tiled_inference(self.model_getter(), inp, tile=self.tile, overlap=self.overlap,
+                                  progress=lambda done, total: self.check_progress(file_path, 0.5 + 0.5 * done / total, 1))
+            img = out[:, :, ::-1]
+            timings["sid"] = time.perf_counter() - st
+        else:
+            img = render_planes(merged, raw)
+        raw.close()
+
+        st = time.perf_counter()
+        out_path = night_output_path(file_path)
+        write_image(out_path, img)
+        timings["write"] = time.perf_counter() - st
+        timings["total"] += sum(timings.get(name, 0.) for name in ("sid", "write"))
+        self.stacked.emit(file_path, timings)
+        self.finished.emit(file_path, out_path)
@@ -0,0 +1,266 @@
+"""Background writer for every image the app produces.
+
+Encodes and writes are queued to one thread. Each file is written to a
+hidden temp file next to its destination and renamed into place, so readers
+never see a partial image. Files written close together are committed as a
+batch: the temp files are fsynced together, renamed, and the directory is
+fsynced once, instead of one sync per file.
+
+JPEG outputs carry a 320x240 EXIF thumbnail (or a hidden .name.thumb.jpg
+sidecar), so the gallery reads a few KB instead of decoding the full image.
+
+    future = get_writer().submit(out_path, img_bgr)   # resolves to out_path
+    write_image(out_path, img_bgr)                    # waits for the commit
+"""
+import os
+import time
+import queue
+import struct
+import threading
+import traceback
+from concurrent.futures import Future
+
+from instrument import instrument
+
+
+thumb_size = (320, 240)
+subsampling_factors = {"444": 0x111111, "422": 0x211111, "420": 0x221111}
+
+
+class JpegEncoder(object):
+    """cv2 (libjpeg-turbo) encoder settings."""
+    def __init__(self, quality=92, subsampling="420", optimize=False, progressive=False):
+        self.quality = quality
+        self.subsampling = subsampling
+        self.optimize = optimize
+        self.progressive = progressive
+
+    def params(self, quality=None):
+        import cv2
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality or self.quality,
+                  cv2.IMWRITE_JPEG_OPTIMIZE, int(self.optimize),
+                  cv2.IMWRITE_JPEG_PROGRESSIVE, int(self.progressive)]
+        if hasattr(cv2, "IMWRITE_JPEG_SAMPLING_FACTOR"):
+            params += [cv2.IMWRITE_JPEG_SAMPLING_FACTOR, subsampling_factors[self.subsampling]]
+        return params
+
+    def encode(self, img, ext=".jpg", quality=None):
+        import cv2
+        params = self.params(quality) if ext.lower() in (".jpg", ".jpeg") else []
+        ok, data = cv2.imencode(ext, img, params)
+        if not ok:
+            raise ValueError(f"could not encode {ext}")
+        return data.tobytes()
+
+    def thumbnail(self, img, size=thumb_size):
+        import cv2
+        h, w = img.shape[:2]
+        scale = min(size[0] / w, size[1] / h, 1.)
+        small = cv2.resize(img, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+        return self.encode(small, quality=80)
+
+
+def exif_thumbnail(thumb):
+    """APP1 segment holding thumb as the IFD1 JPEG thumbnail, None if it does not fit in a segment."""
+    ifd0 = struct.pack("<HI", 0, 8 + 6)
+    ifd1_offset = 8 + len(ifd0)
+    data_offset = ifd1_offset + 2 + 3 * 12 + 4
+    ifd1 = struct.pack("<H", 3)
+    ifd1 += struct.pack("<HHI4s", 0x0103, 3, 1, struct.pack("<H", 6).ljust(4, b"\0"))
+    ifd1 += struct.pack("<HHII", 0x0201, 4, 1, data_offset)
+    ifd1 += struct.pack("<HHII", 0x0202, 4, 1, len(thumb))
+    ifd1 += struct.pack("<I", 0)
+    payload = b"Exif\0\0" + b"II*\0" + struct.pack("<I", 8) + ifd0 + ifd1 + thumb
+    if len(payload) + 2 > 0xFFFF:
+        return None
+    return b"\xff\xe1" + struct.pack(">H", len(payload) + 2) + payload
+
+
+def embed_thumbnail(jpeg, thumb):
+    """Insert the EXIF thumbnail after SOI and JFIF APP0, returns None if it cannot be embedded."""
+    segment = exif_thumbnail(thumb)
+    if segment is None or jpeg[:2] != b"\xff\xd8":
+        return None
+    pos = 2
+    if jpeg[2:4] == b"\xff\xe0":
+        pos = 4 + struct.unpack(">H", jpeg[4:6])[0]
+    return jpeg[:pos] + segment + jpeg[pos:]
+
+
+def sidecar_path(path):
+    folder, name = os.path.split(path)
+    return os.path.join(folder, f".{name}.thumb.jpg")
+
+
+def read_thumbnail(path, limit=1 << 17):
+    """Return the embedded EXIF thumbnail (or the sidecar) of path as JPEG bytes, or None."""
+    try:
+        with open(path, "rb") as f:
+            head = f.read(limit)
+    except OSError:
+        return None
+    pos = 2
+    while head[:2] == b"\xff\xd8" and pos + 4 <= len(head) and head[pos] == 0xFF:
+        marker = head[pos + 1]
+        length = struct.unpack(">H", head[pos + 2:pos + 4])[0]
+        if marker == 0xDA:
+            break
+        if marker == 0xE1 and head[pos + 4:pos + 10] == b"Exif\0\0":
+            thumb = exif_ifd1_thumbnail(head[pos + 10:pos + 2 + length])
+            if thumb is not None:
+                return thumb
+        pos += 2 + length
+    try:
+        with open(sidecar_path(path), "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def exif_ifd1_thumbnail(tiff):
+    try:
+        endian = "<" if tiff[:2] == b"II" else ">"
+        offset = struct.unpack_from(endian + "I", tiff, 4)[0]
+        count = struct.unpack_from(endian + "H", tiff, offset)[0]
+        ifd1 = struct.unpack_from(endian + "I", tiff, offset + 2 + 12 * count)[0]
+        if ifd1 == 0:
+            return None
+        tags = {}
+        for i in range(struct.unpack_from(endian + "H", tiff, ifd1)[0]):
+            tag, typ, n, value = struct.unpack_from(endian + "HHII", tiff, ifd1 + 2 + 12 * i)
+            tags[tag] = value
+        start, length = tags.get(0x0201), tags.get(0x0202)
+        if start is None or length is None or start + length > len(tiff):
+            return None
+        return tiff[start:start + length]
+    except struct.error:
+        return None
+
+
+class OutputWriter(object):
+    def __init__(self, encoder=None, thumbnail="exif", batch_seconds=1.0, batch_files=8, max_pending=8):
+        self.encoder = encoder or JpegEncoder()
+        self.thumbnail = thumbnail
+        self.batch_seconds = batch_seconds
+        self.batch_files = batch_files
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, out_path, img=None, data=None, thumbnail=True):
+        """Queue img (BGR array, encoded here) or data (bytes, written as is), returns a Future of out_path."""
+        future = Future()
+        self.queue.put((out_path, img, data, thumbnail, future))
+        return future
+
+    def pending(self,):
+        return self.queue.unfinished_tasks
+
+    def encode(self, out_path, img, data, thumbnail):
+        """Return [(path, bytes)] to write for one job."""
+        if data is not None:
+            return [(out_path, data)]
+        ext = os.path.splitext(out_path)[1] or ".jpg"
+        with instrument.span("output.encode"):
+            data = self.encoder.encode(img, ext)
+            files = [(out_path, data)]
+            if thumbnail and self.thumbnail and ext.lower() in (".jpg", ".jpeg"):
+                thumb = self.encoder.thumbnail(img)
+                embedded = embed_thumbnail(data, thumb) if self.thumbnail == "exif" else None
+                if embedded is not None:
+                    files = [(out_path, embedded)]
+                else:
+                    files.append((sidecar_path(out_path), thumb))
+        return files
+
+    def commit(self, batch):
+        """Write, fsync and rename a batch of (future, [(path, bytes)]) together."""
+        with instrument.span("output.commit"):
+            written = []
+            for future, files in batch:
+                try:
+                    temps = []
+                    for path, data in files:
+                        folder, name = os.path.split(path)
+                        tmp_path = os.path.join(folder, f".{name}.tmp")
+                        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                        view = memoryview(data)
+                        while view:
+                            view = view[os.write(fd, view):]
+                        temps.append((fd, tmp_path, path))
+                    written.append((future, temps))
+                except Exception as e:
+                    future.set_exception(e)
+
+            folders = set()
+            for future, temps in written:
+                try:
+                    for fd, tmp_path, path in temps:
+                        os.fsync(fd)
+                        os.close(fd)
+                    # sidecars first, so a visible image always finds its thumbnail
+                    for fd, tmp_path, path in reversed(temps):
+                        os.replace(tmp_path, path)
+                        folders.add(os.path.dirname(path) or ".")
+                except Exception as e:
+                    future.set_exception(e)
+            for folder in folders:
+                try:
+                    fd = os.open(folder, os.O_RDONLY)
+                    os.fsync(fd)
+                    os.close(fd)
+                except OSError:
+                    pass
+            for future, temps in written:
+                if not future.done():
+                    future.set_result(temps[0][2])
+
+    def run(self,):
+        while True:
+            batch = []
+            jobs = 0
+            job = self.queue.get()
+            started = time.perf_counter()
+            while job is not None:
+                jobs += 1
+                out_path, img, data, thumbnail, future = job
+                try:
+                    batch.append((future, self.encode(out_path, img, data, thumbnail)))
+                except Exception as e:
+                    traceback.print_exc()
+                    future.set_exception(e)
+                if len(batch) >= self.batch_files or time.perf_counter() - started >= self.batch_seconds:
+                    break
+                try:
+                    job = self.queue.get_nowait()
+                except queue.Empty:
+                    job = None
+            if batch:
+                self.commit(batch)
+            for _ in range(jobs):
+                self.queue.task_done()
+
+
+_writer = None
+_lock = threading.Lock()
+
+
+def configure(**kwargs):
+    """Replace the shared writer, e.g. configure(encoder=JpegEncoder(quality=85, subsampling="444"))."""
+    global _writer
+    with _lock:
+        _writer = OutputWriter(**kwargs)
+        return _writer
+
+
+def get_writer():
+    global _writer
+    with _lock:
+        if _writer is None:
+            _writer = OutputWriter()
+        return _writer
+
+
+def write_image(out_path, img=None, data=None):
+    """Write through the shared writer and wait until the file is in place."""
+    return get_writer().submit(out_path, img, data).result()
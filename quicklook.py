@@ -0,0 +1,161 @@
+"""DNG to _VIS.jpeg rendering.
+
+The quick look mode uses the preview embedded in the DNG when it is large
+enough, and otherwise builds a screen sized image straight from the Bayer
+mosaic with a 2x2 superpixel demosaic, camera white balance and a gamma
+LUT. Uncompressed DNGs are read through raw_access without rawpy, others
+fall back to LibRaw. The high quality mode keeps the full rawpy postprocess.
+"""
+import os
+import json
+import tempfile
+import threading
+
+from instrument import instrument
+from output_writer import write_image
+
+
+screen_width = 800
+cache_path = "./.quicklook.json"
+modes = {"quick": 0, "hq": 1}
+
+_lock = threading.Lock()
+
+
+def embedded_preview(raw, min_width=screen_width):
+    """Return the embedded preview as BGR uint8, or None when there is none or it is too small."""
+    import cv2
+    import numpy as np
+    import rawpy
+    try:
+        thumb = raw.extract_thumb()
+    except (rawpy.LibRawNoThumbnailError, rawpy.LibRawUnsupportedThumbnailError):
+        return None
+    if thumb.format == rawpy.ThumbFormat.JPEG:
+        img = cv2.imdecode(np.frombuffer(thumb.data, np.uint8), cv2.IMREAD_COLOR)
+    else:
+        img = np.ascontiguousarray(thumb.data[:, :, ::-1])
+    if img is None or img.shape[1] < min_width:
+        return None
+    return img
+
+
+def superpixel_render(bayer, pattern, color_desc, black_levels, white_level, wb, width=screen_width, gamma=2.2):
+    """Vectorized quick look render of a Bayer array, returns BGR uint8 at the given width."""
+    import cv2
+    import numpy as np
+    h, w = bayer.shape[0] // 2, bayer.shape[1] // 2
+    size = (width, int(round(h * width / w))) if w > width else (w, h)
+
+    # black levels and gains are per CFA position: keyed by colour, the second green would overwrite the first
+    gains = list(wb)
+    g1 = next(i for i, c in enumerate(color_desc) if chr(c) == "G")
+    if len(gains) > 3 and not gains[3]:
+        gains[3] = gains[g1]  # rawpy often reports 0 for the second green
+    g_gain = gains[g1] or 1.0
+
+    sums, counts = {}, {}
+    for dy in range(2):
+        for dx in range(2):
+            i = pattern[dy][dx]
+            color = chr(color_desc[i])
+            plane = cv2.resize(bayer[dy::2, dx::2].astype(np.float32), size, interpolation=cv2.INTER_AREA)
+            plane = (plane - black_levels[i]) * (gains[i] / g_gain / (white_level - black_levels[i]))
+            sums[color] = sums.get(color, 0.) + plane
+            counts[color] = counts.get(color, 0) + 1
+    img = np.clip(np.dstack([sums[color] / counts[color] for color in "BGR"]), 0, 1)
+
+    lut = (np.linspace(0, 1, 4096) ** (1 / gamma) * 255 + 0.5).astype(np.uint8)
+    return lut[(img * 4095).astype(np.uint16)]
+
+
+def mapped_quicklook(path, width=screen_width):
+    """Quick look straight from the memory mapped DNG, raises ValueError when raw_access cannot read it."""
+    import cv2
+    import numpy as np
+    from raw_access import RawFrame
+    with RawFrame.open(path) as frame:
+        with instrument.span("dng_vis.decode"):
+            preview = frame.preview_jpeg()
+            img = None if preview is None else cv2.imdecode(np.frombuffer(preview, np.uint8), cv2.IMREAD_COLOR)
+            if img is not None and img.shape[1] >= width:
+                return img
+            bayer = frame.bayer()
+        gains = dict(zip("RGB", frame.wb or [1.0, 1.0, 1.0]))
+        color_desc = frame.cfa.encode()
+        return superpixel_render(bayer, [[0, 1], [2, 3]], color_desc, [frame.black_level] * 4,
+                                 frame.white_level, [gains[c] for c in frame.cfa], width)
+
+
+def render_quicklook(path, width=screen_width):
+    try:
+        return mapped_quicklook(path, width)
+    except ValueError:
+        pass
+    import rawpy
+    with rawpy.imread(path) as raw:
+        img = embedded_preview(raw, width)
+        if img is not None:
+            return img
+        wb = raw.camera_whitebalance
+        if not any(wb):
+            wb = [1.0] * len(raw.color_desc)
+        return superpixel_render(raw.raw_image_visible, raw.raw_pattern, raw.color_desc,
+                                 raw.black_level_per_channel, raw.white_level, wb, width)
+
+
+def render_hq(path):
+    import rawpy
+    with rawpy.imread(path) as raw:
+        return raw.postprocess(use_camera_wb=True, half_size=True)[:, :, ::-1]
+
+
+def load_cache():
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def is_fresh(path, out_path, mode):
+    """True when out_path was rendered from the current path in mode or a better one."""
+    entry = load_cache().get(os.path.abspath(out_path))
+    if entry is None or not os.path.exists(out_path):
+        return False
+    return entry[0] == os.stat(path).st_mtime_ns and modes[entry[1]] >= modes[mode]
+
+
+def mark_fresh(path, out_path, mode):
+    """Record out_path in the cache.
+
+    Batch workers update the cache from several processes, so the read,
+    modify, write runs under an flock on a lock file next to it, and the
+    new version is written through a unique temporary file.
+    """
+    import fcntl
+    with _lock, open(cache_path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        cache = load_cache()
+        cache[os.path.abspath(out_path)] = [os.stat(path).st_mtime_ns, mode]
+        fd, tmp_path = tempfile.mkstemp(prefix=".quicklook.", suffix=".tmp", dir=os.path.dirname(os.path.abspath(cache_path)))
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(cache, f)
+            os.replace(tmp_path, cache_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+def visualize_dng(path, out_path, mode="quick"):
+    """Render path into out_path unless a fresh enough render exists, returns True if it wrote."""
+    if is_fresh(path, out_path, mode):
+        return False
+    with instrument.span("dng_vis"):
+        with instrument.span("dng_vis.compute"):
+            img = render_quicklook(path) if mode == "quick" else render_hq(path)
+        with instrument.span("dng_vis.write"):
+            write_image(out_path, img)
+    mark_fresh(path, out_path, mode)
+    return True
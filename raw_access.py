@@ -0,0 +1,293 @@
+"""Memory mapped access to raw Bayer data.
+
+RawFrame reads either a Broadcom Bayer JPEG as written by
+camera.capture(..., bayer=True), or an uncompressed DNG. The file is memory
+mapped and the packed 10/12-bit or 16-bit samples are unpacked with
+vectorised NumPy into a per-thread buffer that is reused between frames.
+Consumers take black level corrected 4-channel views from planes() instead
+of decoding the file again.
+"""
+import mmap
+import struct
+import threading
+
+import numpy as np
+
+
+# raw block size -> (rows, stride, height, width, bits, default bayer order)
+broadcom_formats = {
+    6404096: (1952, 3264, 1944, 2592, 10, "BGGR"),
+    10270208: (2480, 4128, 2464, 3280, 10, "BGGR"),
+    18711040: (3056, 6112, 3040, 4056, 12, "BGGR"),
+}
+broadcom_header = 32768
+broadcom_orders = {0: "RGGB", 1: "GBRG", 2: "BGGR", 3: "GRBG"}
+broadcom_black = {10: 64, 12: 256}
+
+# SID packing order of the 2x2 positions, (0, 0), (0, 1), (1, 1), (1, 0)
+sid_positions = ((0, 0), (0, 1), (1, 1), (1, 0))
+# Amplification applied to the normalised input when sid_model is not
+# installed, preprocessing_ratio() measures the one sid_model.preprocessing uses.
+sid_ratio = 1.0
+
+_buffers = threading.local()
+
+
+def broadcom_block(buf):
+    """Return (offset, format) of the Broadcom raw block appended to a Bayer JPEG, or (None, None)."""
+    size = len(buf)
+    for block, fmt in broadcom_formats.items():
+        if size >= block and bytes(buf[size - block:size - block + 4]) == b"BRCM":
+            return size - block, fmt
+    return None, None
+
+
+def reusable(name, shape, dtype):
+    buf = getattr(_buffers, name, None)
+    if buf is None or buf.shape != shape or buf.dtype != dtype:
+        buf = np.empty(shape, dtype)
+        setattr(_buffers, name, buf)
+    return buf
+
+
+def unpack_12(data, out):
+    """Unpack MIPI style 12-bit rows (two pixels in three bytes, low nibbles last)."""
+    b = data.reshape(data.shape[0], -1, 3)
+    even, odd = out[:, 0::2], out[:, 1::2]
+    np.left_shift(b[:, :, 0], 4, out=even, dtype=np.uint16)
+    even |= b[:, :, 2] & 0x0F
+    np.left_shift(b[:, :, 1], 4, out=odd, dtype=np.uint16)
+    odd |= b[:, :, 2] >> 4
+    return out
+
+
+def unpack_10(data, out):
+    """Unpack MIPI style 10-bit rows (four pixels in five bytes, low bits last)."""
+    b = data.reshape(data.shape[0], -1, 5)
+    for i in range(4):
+        view = out[:, i::4]
+        np.left_shift(b[:, :, i], 2, out=view, dtype=np.uint16)
+        view |= (b[:, :, 4] >> (2 * i)) & 0x03
+    return out
+
+
+def unpack_12_be(data, out):
+    """Unpack DNG 12-bit rows (big endian bit packing)."""
+    b = data.reshape(data.shape[0], -1, 3)
+    even, odd = out[:, 0::2], out[:, 1::2]
+    np.left_shift(b[:, :, 0], 4, out=even, dtype=np.uint16)
+    even |= b[:, :, 1] >> 4
+    np.left_shift(b[:, :, 1] & 0x0F, 8, out=odd, dtype=np.uint16)
+    odd |= b[:, :, 2]
+    return out
+
+
+class RawFrame(object):
+    def __init__(self, buf, mm=None):
+        self.buf = buf
+        self.mm = mm
+        self.bayer_data = None
+        self.width = self.height = 0
+        self.bits = 16
+        self.packing = None
+        self.cfa = "BGGR"
+        self.black_level = 0.
+        self.white_level = 65535.
+        self.wb = None
+        self.preview_range = None
+
+    @classmethod
+    def open(cls, path):
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        frame = cls(mm, mm)
+        if path.lower().endswith(".dng"):
+            frame.parse_dng()
+        else:
+            frame.parse_broadcom()
+        return frame
+
+    @classmethod
+    def from_buffer(cls, data):
+        frame = cls(memoryview(data))
+        frame.parse_broadcom()
+        return frame
+
+    def close(self,):
+        self.bayer_data = None
+        if self.mm is not None:
+            try:
+                self.mm.close()
+            except BufferError:
+                pass  # a caller still holds a view, the map goes with it
+            self.mm = None
+
+    def __enter__(self,):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def parse_broadcom(self,):
+        start, fmt = broadcom_block(self.buf)
+        if start is None:
+            raise ValueError("no Broadcom raw block found")
+        rows, stride, height, width, bits, order = fmt
+        offset = start + broadcom_header
+        data = np.frombuffer(self.buf, np.uint8, rows * stride, offset).reshape(rows, stride)
+        self.bayer_data = data[:height, :width * bits // 8]
+        self.width, self.height, self.bits = width, height, bits
+        self.packing = "mipi"
+        self.cfa = self.broadcom_order(start) or order
+        self.black_level = broadcom_black[bits]
+        self.white_level = (1 << bits) - 1
+
+    def broadcom_order(self, offset):
+        try:
+            import ctypes
+            from picamera.array import BroadcomRawHeader
+        except ImportError:
+            return None
+        header = BroadcomRawHeader.from_buffer_copy(bytes(self.buf[offset + 176:offset + 176 + ctypes.sizeof(BroadcomRawHeader)]))
+        return broadcom_orders.get(header.bayer_order)
+
+    def read_ifd(self, offset, endian):
+        sizes = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8}
+        formats = {1: "B", 2: "c", 3: "H", 4: "I", 5: "II", 6: "b", 7: "B", 8: "h", 9: "i", 10: "ii", 11: "f", 12: "d"}
+        count, = struct.unpack_from(endian + "H", self.buf, offset)
+        tags = {}
+        for i in range(count):
+            tag, typ, n, value = struct.unpack_from(endian + "HHI4s", self.buf, offset + 2 + 12 * i)
+            if typ not in sizes:
+                continue
+            nbytes = sizes[typ] * n
+            pos = offset + 2 + 12 * i + 8
+            if nbytes > 4:
+                pos, = struct.unpack_from(endian + "I", self.buf, pos)
+            values = struct.unpack_from(endian + formats[typ] * n, self.buf, pos)
+            if typ in (5, 10):
+                values = [values[j] / values[j + 1] if values[j + 1] else 0. for j in range(0, len(values), 2)]
+            tags[tag] = list(values)
+        next_offset, = struct.unpack_from(endian + "I", self.buf, offset + 2 + 12 * count)
+        return tags, next_offset
+
+    def parse_dng(self,):
+        endian = "<" if bytes(self.buf[:2]) == b"II" else ">"
+        offset, = struct.unpack_from(endian + "I", self.buf, 4)
+        ifd0, _ = self.read_ifd(offset, endian)
+        ifds = [ifd0] + [self.read_ifd(sub, endian)[0] for sub in ifd0.get(330, [])]
+
+        raw = None
+        for ifd in ifds:
+            if ifd.get(254, [0])[0] == 0 and ifd.get(262, [0])[0] == 32803:
+                raw = ifd
+            elif ifd.get(254, [0])[0] == 1 and ifd.get(259, [1])[0] in (6, 7) and 273 in ifd:
+                self.preview_range = (ifd[273][0], sum(ifd[279]))
+        if raw is None:
+            raise ValueError("no CFA image in DNG")
+        if raw.get(259, [1])[0] != 1:
+            raise ValueError("compressed DNG, use rawpy")
+
+        self.width, self.height = raw[256][0], raw[257][0]
+        self.bits = raw[258][0]
+        if self.bits not in (12, 16):
+            raise ValueError(f"unsupported DNG bit depth {self.bits}")
+        if 273 in raw and 279 in raw:
+            offsets, counts = raw[273], raw[279]
+        elif 324 in raw and 325 in raw:
+            # tiles (as pidng writes them) are only mapped when each one spans the full width
+            if raw.get(322, [0])[0] != self.width or len(raw[324]) * raw.get(323, [0])[0] < self.height:
+                raise ValueError("DNG tiles do not span the image width")
+            offsets, counts = raw[324], raw[325]
+        else:
+            raise ValueError("DNG has neither strips nor tiles")
+        if len(offsets) != len(counts) or any(o + c > len(self.buf) for o, c in zip(offsets, counts)):
+            raise ValueError("DNG image data out of bounds")
+        if len(offsets) > 1 and any(offsets[i] + counts[i] != offsets[i + 1] for i in range(len(offsets) - 1)):
+            data = np.concatenate([np.frombuffer(self.buf, np.uint8, c, o) for o, c in zip(offsets, counts)])
+        else:
+            data = np.frombuffer(self.buf, np.uint8, sum(counts), offsets[0])
+        size = self.height * self.width * self.bits // 8
+        if len(data) < size:
+            raise ValueError("DNG image data is truncated")
+
+        if self.bits == 16:
+            self.bayer_data = data[:size].view(endian + "u2").reshape(self.height, self.width)
+            self.packing = None
+        else:
+            self.bayer_data = data[:size].reshape(self.height, -1)
+            self.packing = "dng"
+
+        pattern = raw.get(33422, [2, 1, 1, 0])
+        self.cfa = "".join("RGB"[c] for c in pattern[:4])
+        self.black_level = float(np.mean(raw.get(50714, [0])))
+        self.white_level = float(raw.get(50717, [(1 << self.bits) - 1])[0])
+        neutral = ifd0.get(50728)
+        if neutral:
+            self.wb = [1. / v if v else 1. for v in neutral]
+
+    def bayer(self, out=None):
+        """Return the mosaic as uint16 (H, W), unpacked into out or a reused per-thread buffer."""
+        if self.packing is None and self.bayer_data.dtype.byteorder in ("=", "<", "|"):
+            return self.bayer_data
+        if out is None:
+            out = reusable("bayer", (self.height, self.width), np.uint16)
+        if self.packing is None:
+            out[:] = self.bayer_data
+        elif self.packing == "dng":
+            unpack_12_be(self.bayer_data, out)
+        elif self.bits == 12:
+            unpack_12(self.bayer_data, out)
+        else:
+            unpack_10(self.bayer_data, out)
+        return out
+
+    def planes(self, dtype=np.float32, positions=sid_positions, normalize=True, out=None):
+        """Black level corrected (4, H/2, W/2) planes in the given 2x2 position order."""
+        bayer = self.bayer()
+        h, w = self.height // 2, self.width // 2
+        if out is None:
+            out = np.empty((len(positions), h, w), dtype)
+        scale = 1. / (self.white_level - self.black_level) if normalize else 1.
+        for i, (dy, dx) in enumerate(positions):
+            np.subtract(bayer[dy:2 * h:2, dx:2 * w:2], self.black_level, out=out[i], dtype=dtype, casting="unsafe")
+            out[i] *= scale
+        np.maximum(out, 0, out=out)
+        return out
+
+    def colors(self, positions=sid_positions):
+        return [self.cfa[dy * 2 + dx] for dy, dx in positions]
+
+    def preview_jpeg(self,):
+        if self.preview_range is None:
+            return None
+        offset, length = self.preview_range
+        return bytes(self.buf[offset:offset + length])
+
+
+def preprocessing_ratio(path):
+    """Amplification sid_model.preprocessing applies to path relative to planes(), None without sid_model."""
+    try:
+        from sid_model import preprocessing
+    except ImportError:
+        return None
+    reference = np.asarray(preprocessing(path), np.float32)
+    with RawFrame.open(path) as frame:
+        inp = frame.planes()
+    h, w = min(reference.shape[1], inp.shape[1]), min(reference.shape[2], inp.shape[2])
+    reference, inp = reference[:, :h, :w], inp[:, :h, :w]
+    mask = (inp > 1e-3) & (reference < 1.0)
+    if not mask.any():
+        return None
+    return float(np.median(reference[mask] / inp[mask]))
+
+
+def sid_input(path, dtype=np.float32, ratio=None):
+    """SID network input for path: (4, H/2, W/2) planes in SID order, normalised, amplified and clipped."""
+    ratio = sid_ratio if ratio is None else ratio
+    with RawFrame.open(path) as frame:
+        inp = frame.planes(dtype)
+    if ratio != 1.0:
+        inp *= ratio
+    np.minimum(inp, 1.0, out=inp)
+    return inp
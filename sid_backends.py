@@ -0,0 +1,248 @@
+"""CPU inference backends for the SID model.
+
+    eager_fp32   SeeInDark with the quantized weights dequantized to float
+    fx_quant     the FX quantized model as shipped (sid_cache, the reference)
+    ts_frozen    the FX quantized model re-converted for the selected
+                 quantized engine (qnnpack or fbgemm), TorchScript frozen,
+                 fed channels_last, cached like sid_cache per engine
+    onnx         the fp32 model exported to ONNX and run by ONNX Runtime
+
+Every backend is a callable taking and returning (N, C, H, W) torch
+tensors, so tiled_inference runs any of them. `python sid_backends.py bench`
+validates each backend against fx_quant on the same input, times them at
+the tile size and saves the fastest valid one to backend_path, which
+LazySIDModel then loads.
+"""
+import os
+import sys
+import json
+import time
+import platform
+
+
+backend_path = "./.sid_backend.json"
+onnx_path = "./.sid_model.onnx"
+frozen_path = "./.sid_model.ts.frozen"
+backends = ["eager_fp32", "fx_quant", "ts_frozen", "onnx"]
+# (mean, max) absolute difference to the fx_quant output on a [0, 1] image
+tolerance = (0.02, 0.25)
+
+
+def set_threads(threads):
+    import torch
+    if threads:
+        torch.set_num_threads(threads)
+
+
+def select_engine(engine=None):
+    """Set the quantized engine, defaulting to qnnpack on ARM and fbgemm elsewhere, returns the one in use."""
+    import torch
+    supported = torch.backends.quantized.supported_engines
+    if engine is None:
+        engine = "qnnpack" if platform.machine().startswith(("arm", "aarch")) else "fbgemm"
+    if engine not in supported:
+        engine = next(e for e in ("qnnpack", "fbgemm") if e in supported)
+    torch.backends.quantized.engine = engine
+    return engine
+
+
+def dequantized_model(quantized):
+    """SeeInDark in fp32 carrying the weights of the FX quantized model."""
+    import torch
+    from sid_model import SeeInDark
+    model = SeeInDark().eval()
+    modules = dict(model.named_modules())
+    with torch.no_grad():
+        for name, module in quantized.named_modules():
+            if name not in modules or not callable(getattr(module, "weight", None)):
+                continue
+            target = modules[name]
+            target.weight.copy_(module.weight().dequantize())
+            bias = module.bias()
+            if bias is not None and target.bias is not None:
+                target.bias.copy_(bias)
+    return model
+
+
+class ChannelsLast(object):
+    def __init__(self, model):
+        self.model = model
+
+    def __call__(self, x):
+        import torch
+        return self.model(x.contiguous(memory_format=torch.channels_last)).contiguous()
+
+
+class OnnxModel(object):
+    def __init__(self, session):
+        self.session = session
+        self.input_name = session.get_inputs()[0].name
+
+    def __call__(self, x):
+        import torch
+        return torch.from_numpy(self.session.run(None, {self.input_name: x.numpy()})[0])
+
+
+def export_onnx(model, path=onnx_path, tag=None):
+    import torch
+    torch.onnx.export(model, torch.zeros(1, 4, 64, 64), path + ".tmp", input_names=["raw"], output_names=["rgb"],
+                      dynamic_axes={"raw": {0: "n", 2: "h", 3: "w"}, "rgb": {0: "n", 2: "h", 3: "w"}},
+                      opset_version=13)
+    os.replace(path + ".tmp", path)
+    with open(path + ".json", "w") as f:
+        json.dump(tag, f)
+
+
+def load_frozen(path, engine=None, cache=frozen_path):
+    """ts_frozen for the weights at path, from the cache when its tag (sid_cache's plus the quantized engine) matches."""
+    import torch
+    from sid_cache import build_model, cache_tag
+    tag = dict(cache_tag(path), engine=select_engine(engine))
+    try:
+        with open(cache + ".json") as f:
+            if json.load(f) == tag:
+                return ChannelsLast(torch.jit.load(cache).eval())
+    except (OSError, ValueError, RuntimeError):
+        pass
+
+    model = build_model(path)
+    try:
+        scripted = torch.jit.script(model)
+    except Exception:
+        scripted = torch.jit.trace(model, torch.zeros(1, 4, 64, 64))
+    frozen = torch.jit.optimize_for_inference(torch.jit.freeze(scripted.eval()))
+    try:
+        torch.jit.save(frozen, cache + ".tmp")
+        os.replace(cache + ".tmp", cache)
+        with open(cache + ".json", "w") as f:
+            json.dump(tag, f)
+    except Exception as e:
+        print(f"sid_backends: could not cache ts_frozen: {e}")
+    return ChannelsLast(frozen)
+
+
+def load_backend(name, path=None, threads=None, engine=None):
+    """Build backend name for the weights at path, returns a callable model."""
+    from sid_cache import pth_path, load_model, cache_tag
+    path = path or pth_path
+    set_threads(threads)
+
+    if name == "fx_quant":
+        return load_model(path)
+    if name == "eager_fp32":
+        return dequantized_model(load_model(path))
+    if name == "ts_frozen":
+        return load_frozen(path, engine)
+    if name == "onnx":
+        import onnxruntime as ort
+        tag = cache_tag(path)
+        try:
+            with open(onnx_path + ".json") as f:
+                fresh = json.load(f) == tag
+        except (OSError, ValueError):
+            fresh = False
+        if not fresh:
+            export_onnx(dequantized_model(load_model(path)), onnx_path, tag)
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = threads or os.cpu_count() or 4
+        options.inter_op_num_threads = 1
+        return OnnxModel(ort.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"]))
+    raise ValueError(f"unknown SID backend {name}")
+
+
+def load_selected(path=None, config_path=backend_path):
+    """Load the backend saved by bench, or fx_quant when none was picked yet."""
+    try:
+        with open(config_path) as f:
+            config = json.load(f)
+    except (OSError, ValueError):
+        config = {"backend": "fx_quant"}
+    return load_backend(config["backend"], path, config.get("threads"), config.get("engine"))
+
+
+def bench_input(size=512, dng_path=None):
+    """A (1, 4, size, size) input: a crop of dng_path as Super Night reads it, or a smooth synthetic frame."""
+    import numpy as np
+    import torch
+    if dng_path is not None:
+        from sid_tiling import sid_input
+        inp = np.asarray(sid_input(dng_path), np.float32)
+        y, x = (inp.shape[1] - size) // 2, (inp.shape[2] - size) // 2
+        inp = inp[:, y:y + size, x:x + size]
+    else:
+        yy, xx = np.mgrid[0:size, 0:size].astype(np.float32) / size
+        rng = np.random.default_rng(0)
+        inp = np.stack([xx * 0.2, yy * 0.2, (xx + yy) * 0.1, (1 - xx) * 0.2])
+        inp = np.clip(inp + rng.normal(0, 0.01, inp.shape), 0, 1).astype(np.float32)
+    return torch.from_numpy(np.ascontiguousarray(inp))[None]
+
+
+def bench(path=None, threads=None, size=512, repeat=3, dng_path=None, names=backends, save=True, engine=None):
+    """Validate and time every backend, returns rows and saves the fastest valid one."""
+    import torch
+    threads = threads or os.cpu_count() or 4
+    inp = bench_input(size, dng_path)
+    reference = None
+    rows = []
+    for name in ["fx_quant"] + [n for n in names if n != "fx_quant"]:
+        row = {"backend": name, "threads": threads}
+        try:
+            st = time.perf_counter()
+            model = load_backend(name, path, threads, engine)
+            row["load_s"] = time.perf_counter() - st
+            if name == "ts_frozen":
+                row["engine"] = torch.backends.quantized.engine
+            with torch.no_grad():
+                out = torch.clip(model(inp), 0, 1)
+                st = time.perf_counter()
+                for _ in range(repeat):
+                    model(inp)
+            row["tile_s"] = (time.perf_counter() - st) / repeat
+            if reference is None:
+                reference = out
+            diff = (out - reference).abs()
+            row["mean_abs"], row["max_abs"] = float(diff.mean()), float(diff.max())
+            row["valid"] = row["mean_abs"] <= tolerance[0] and row["max_abs"] <= tolerance[1]
+        except Exception as e:
+            row["error"] = str(e)
+            row["valid"] = False
+        rows.append(row)
+
+    valid = [row for row in rows if row["valid"]]
+    if save and valid:
+        best = min(valid, key=lambda row: row["tile_s"])
+        config = {"backend": best["backend"], "threads": threads, "engine": best.get("engine"),
+                  "host": f"{platform.machine()} x{os.cpu_count()}", "tile": size}
+        with open(backend_path, "w") as f:
+            json.dump(config, f, indent=1)
+    return rows
+
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["bench"])
+    parser.add_argument("--weights")
+    parser.add_argument("--threads", type=int)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--dng")
+    parser.add_argument("--engine", choices=["qnnpack", "fbgemm"], help="quantized engine for ts_frozen")
+    args = parser.parse_args(argv[1:])
+
+    rows = bench(args.weights, args.threads, args.size, args.repeat, args.dng, engine=args.engine)
+    print(f"{'backend':>11} {'load s':>7} {'tile s':>7} {'mean':>7} {'max':>7}  valid")
+    for row in rows:
+        if "error" in row:
+            print(f"{row['backend']:>11}  error: {row['error']}")
+            continue
+        print(f"{row['backend']:>11} {row['load_s']:7.2f} {row['tile_s']:7.3f} {row['mean_abs']:7.4f} "
+              f"{row['max_abs']:7.4f}  {row['valid']}")
+    if os.path.exists(backend_path):
+        with open(backend_path) as f:
+            print(f"selected: {json.load(f)}")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,135 @@
+"""Lazy loading of the quantized SID model with a TorchScript cache.
+
+Building the model runs FX quantization (prepare_fx / convert_fx) before the
+state dict can be loaded. The converted model is saved once as TorchScript
+next to a tag of the cache format, torch version and weights hash, and later
+loads take the TorchScript file as long as the tag matches.
+
+`python sid_cache.py measure [weights]` compares cold, cached and lazy start up.
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import threading
+
+
+pth_path = "/home/pi/workspace/digtial_camera/pth.txt"
+cache_path = "./.sid_model.ts"
+cache_version = 1
+
+
+def weights_hash(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def cache_tag(path):
+    import torch
+    return {"version": cache_version, "torch": torch.__version__, "weights": weights_hash(path)}
+
+
+def build_model(path=pth_path):
+    from sid_model import init_sid_model
+    return init_sid_model(path)
+
+
+def save_cache(model, cache=cache_path, tag=None):
+    import torch
+    try:
+        scripted = torch.jit.script(model)
+    except Exception:
+        scripted = torch.jit.trace(model, torch.zeros(1, 4, 64, 64))
+    torch.jit.save(scripted, cache + ".tmp")
+    os.replace(cache + ".tmp", cache)
+    with open(cache + ".json", "w") as f:
+        json.dump(tag, f)
+
+
+def load_model(path=pth_path, cache=cache_path):
+    """Return the SID model, from the TorchScript cache when it matches the weights."""
+    import torch
+    tag = cache_tag(path)
+    try:
+        with open(cache + ".json") as f:
+            if json.load(f) == tag:
+                return torch.jit.load(cache).eval()
+    except (OSError, ValueError, RuntimeError):
+        pass
+
+    model = build_model(path)
+    try:
+        save_cache(model, cache, tag)
+    except Exception as e:
+        print(f"sid_cache: could not cache the model: {e}")
+    return model
+
+
+class LazySIDModel(object):
+    """Loads the SID model on first call, or earlier in the background through warm().
+
+    The backend picked by `python sid_backends.py bench` is used when one was
+    saved, the cached FX quantized model otherwise.
+    """
+    def __init__(self, path=pth_path, cache=cache_path, backend_config="./.sid_backend.json"):
+        self.path = path
+        self.cache = cache
+        self.backend_config = backend_config
+        self.model = None
+        self.lock = threading.Lock()
+
+    def get(self,):
+        with self.lock:
+            if self.model is None and os.path.exists(self.backend_config):
+                from sid_backends import load_selected
+                self.model = load_selected(self.path, self.backend_config)
+            elif self.model is None:
+                self.model = load_model(self.path, self.cache)
+            return self.model
+
+    def warm(self,):
+        threading.Thread(target=self.get, daemon=True).start()
+
+    def __call__(self, *args):
+        return self.get()(*args)
+
+
+def measure(path=pth_path, cache=cache_path):
+    if os.path.exists(cache + ".json"):
+        os.remove(cache + ".json")
+
+    st = time.perf_counter()
+    build_model(path)
+    cold = time.perf_counter() - st
+
+    st = time.perf_counter()
+    load_model(path, cache)
+    first = time.perf_counter() - st
+
+    st = time.perf_counter()
+    load_model(path, cache)
+    cached = time.perf_counter() - st
+
+    st = time.perf_counter()
+    lazy = LazySIDModel(path, cache)
+    lazy_init = time.perf_counter() - st
+    st = time.perf_counter()
+    lazy.get()
+    lazy_first_use = time.perf_counter() - st
+
+    print(f"cold build (prepare_fx/convert_fx/load_state_dict): {cold:.3f} s")
+    print(f"cold build + write TorchScript cache:              {first:.3f} s")
+    print(f"cached TorchScript load:                           {cached:.3f} s")
+    print(f"lazy at startup:                                   {lazy_init * 1000:.3f} ms")
+    print(f"lazy first use (cached):                           {lazy_first_use:.3f} s")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "measure":
+        measure(*sys.argv[2:3])
+    else:
+        print("usage: python sid_cache.py measure [weights]")
@@ -0,0 +1,143 @@
+import numpy as np
+import torch
+
+from instrument import instrument
+from output_writer import get_writer
+
+
+def tile_starts(length, tile, overlap):
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, tile - overlap))
+    return starts + [length - tile]
+
+
+def ramp(length, overlap, first, last):
+    """Blend weights of one tile axis: linear ramps over the overlaps it shares with its neighbours."""
+    weight = np.ones(length, np.float32)
+    overlap = min(overlap, length // 2)
+    if overlap > 0:
+        r = (np.arange(overlap, dtype=np.float32) + 0.5) / overlap
+        if not first:
+            weight[:overlap] = r
+        if not last:
+            weight[-overlap:] = r[::-1]
+    return weight
+
+
+def run_tile(model, tile, multiple=16):
+    """Run model on one (C, H, W) tile, padding it to a multiple of the network stride."""
+    c, h, w = tile.shape
+    pad_h, pad_w = (-h) % multiple, (-w) % multiple
+    if pad_h or pad_w:
+        tile = np.pad(tile, ((0, 0), (0, pad_h), (0, pad_w)), mode="edge")
+    out = model(torch.from_numpy(np.ascontiguousarray(tile))[None])[0]
+    scale = out.shape[1] // tile.shape[1]
+    out = torch.clip(out[:, :h * scale, :w * scale], 0, 1)
+    return out.permute(1, 2, 0).numpy()
+
+
+def finalize(acc, wsum):
+    return (acc / np.maximum(wsum, 1e-8) * 255.).astype("uint8")
+
+
+@torch.no_grad()
+def tiled_inference(model, inp, tile=512, overlap=32, scale=2, out_channels=3, progress=None):
+    """Run the SID model over a packed (C, H, W) raw frame tile by tile.
+
+    Tiles overlap by `overlap` input pixels and are feathered together with
+    linear ramps. Only one band of tile rows is held in float, finished rows
+    are written straight into the uint8 output, so peak memory follows the
+    tile size instead of the sensor resolution. Returns an RGB uint8 image of
+    (H * scale, W * scale, out_channels). progress(done, total) is called
+    after every tile.
+    """
+    c, h, w = inp.shape
+    tile = max(16, tile - tile % 16)
+    overlap = min(overlap, tile // 2)
+    th, tw = min(tile, h), min(tile, w)
+    ys = tile_starts(h, th, overlap)
+    xs = tile_starts(w, tw, overlap)
+    total = len(ys) * len(xs)
+    done = 0
+
+    out = np.empty((h * scale, w * scale, out_channels), np.uint8)
+    acc = np.zeros((th * scale, w * scale, out_channels), np.float32)
+    wsum = np.zeros((th * scale, w * scale, 1), np.float32)
+    band_top = 0
+
+    for yi, y in enumerate(ys):
+        if y > band_top:
+            shift = (y - band_top) * scale
+            out[band_top * scale:y * scale] = finalize(acc[:shift], wsum[:shift])
+            acc[:-shift] = acc[shift:]
+            acc[-shift:] = 0
+            wsum[:-shift] = wsum[shift:]
+            wsum[-shift:] = 0
+            band_top = y
+
+        wy = np.repeat(ramp(th, overlap, yi == 0, yi == len(ys) - 1), scale)
+        for xi, x in enumerate(xs):
+            wx = np.repeat(ramp(tw, overlap, xi == 0, xi == len(xs) - 1), scale)
+            weight = np.outer(wy, wx)[..., None]
+            tile_out = run_tile(model, inp[:, y:y + th, x:x + tw])
+            acc[:, x * scale:(x + tw) * scale] += tile_out * weight
+            wsum[:, x * scale:(x + tw) * scale] += weight
+            done += 1
+            if progress is not None:
+                progress(done, total)
+
+    rows = (h - band_top) * scale
+    out[band_top * scale:] = finalize(acc[:rows], wsum[:rows])
+    return out
+
+
+def sid_input(file_path):
+    """Packed SID input from sid_model.preprocessing, or the shared raw layer when sid_model is not installed.
+
+    preprocessing stays the primary path until raw_access.sid_input is shown
+    to match it (the sid_parity benchmark check).
+    """
+    try:
+        from sid_model import preprocessing
+    except ImportError:
+        import raw_access
+        return raw_access.sid_input(file_path)
+    return preprocessing(file_path)
+
+
+def bin_input(inp, factor):
+    """Average factor x factor blocks of a packed (C, H, W) input."""
+    c, h, w = inp.shape
+    h, w = h - h % factor, w - w % factor
+    return inp[:, :h, :w].reshape(c, h // factor, factor, w // factor, factor).mean(axis=(2, 4))
+
+
+@torch.no_grad()
+def preview_inference(model, inp, size=384):
+    """Run the model once on inp binned down to about size pixels on its long side, returns RGB uint8."""
+    factor = max(1, -(-max(inp.shape[1:]) // size))
+    out = run_tile(model, bin_input(inp, factor).astype(np.float32))
+    # run_tile returns a permuted view, QImage needs packed rows
+    return np.ascontiguousarray((out * 255.).astype("uint8"))
+
+
+def super_night(model, file_path, out_path, tile=512, overlap=32, progress=None, preview=None):
+    """Run Super Night on the DNG file_path and queue the RGB result for out_path.
+
+    Returns the output writer future, which resolves once the file is in
+    place. With a preview callback, a binned low resolution pass is run first and
+    its RGB uint8 result handed to preview(img) before the full render.
+    """
+    with instrument.span("super_night"):
+        with instrument.span("super_night.preprocess"):
+            inp = sid_input(file_path)
+        if preview is not None:
+            with instrument.span("super_night.preview"):
+                preview(preview_inference(model, inp))
+        if progress is not None:
+            progress(0, 1)
+        with instrument.span("super_night.inference"):
+            out = tiled_inference(model, inp, tile=tile, overlap=overlap, progress=progress)
+        with instrument.span("super_night.encode"):
+            return get_writer().submit(out_path, np.ascontiguousarray(out[:, :, ::-1]))
@@ -0,0 +1,62 @@
+"""Time-to-preview profiler.
+
+Enabled with `python app.py --profile` or RASPY_PROFILE=1. app.py calls
+profiler.mark(stage) after each import group and init step, and the
+breakdown is printed once the camera preview is running, when the camera
+thread reports that start_preview returned. Later marks are ignored.
+"""
+import os
+import sys
+import time
+import threading
+
+
+def process_age():
+    """Seconds since the interpreter process was started, None where /proc is unavailable."""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class StartupProfiler(object):
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.stages = []
+        self.reported = False
+        self.lock = threading.Lock()
+        if enabled:
+            age = process_age()
+            if age is not None:
+                self.stages.append(("interpreter start", age))
+            self.last = time.perf_counter()
+
+    def mark(self, stage):
+        if not self.enabled:
+            return
+        with self.lock:
+            if self.reported:
+                return
+            now = time.perf_counter()
+            self.stages.append((stage, now - self.last))
+            self.last = now
+
+    def report(self, file=sys.stderr):
+        if not self.enabled:
+            return
+        with self.lock:
+            if self.reported:
+                return
+            self.reported = True
+        total = sum(t for _, t in self.stages)
+        print("startup profile (time to preview):", file=file)
+        for stage, t in self.stages:
+            print(f"  {stage:<28} {t * 1000:9.1f} ms {t / total * 100:5.1f}%", file=file)
+        print(f"  {'total':<28} {total * 1000:9.1f} ms", file=file)
+
+
+profiler = StartupProfiler(os.environ.get("RASPY_PROFILE") == "1" or "--profile" in sys.argv)
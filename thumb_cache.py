@@ -0,0 +1,188 @@
+import os
+import json
+import struct
+import hashlib
+import threading
+from collections import OrderedDict
+from PyQt5 import QtCore, QtGui
+
+from instrument import instrument
+from output_writer import read_thumbnail
+
+
+cache_folder = "./.thumb_cache/"
+small_size = (75, 75)
+large_size = (320, 240)
+entry_magic = b"THM1"
+
+
+def encode_image(img, quality=85):
+    buf = QtCore.QBuffer()
+    buf.open(QtCore.QIODevice.WriteOnly)
+    img.save(buf, "JPG", quality)
+    return bytes(buf.data())
+
+
+def decode_image(data):
+    img = QtGui.QImage()
+    img.loadFromData(data, "JPG")
+    return img
+
+
+def decode_thumbnails(file):
+    """Decode a gallery file straight to the 320x240 viewer size and the 75x75 strip size.
+
+    Outputs written by output_writer carry a 320x240 thumbnail that is used
+    as is. Otherwise QImageReader lets the JPEG decoder skip DCT scales, so a
+    12 MP capture is never materialised at full resolution.
+    """
+    thumb = read_thumbnail(file)
+    if thumb is not None:
+        img = QtGui.QImage.fromData(thumb)
+        if img.width() >= large_size[0] or img.height() >= large_size[1]:
+            img_resized = img.scaled(*small_size, aspectRatioMode=QtCore.Qt.KeepAspectRatio, transformMode=QtCore.Qt.FastTransformation)
+            return img_resized, img
+    reader = QtGui.QImageReader(file)
+    size = reader.size()
+    if size.isValid():
+        reader.setScaledSize(size.scaled(*large_size, QtCore.Qt.KeepAspectRatio))
+    img = reader.read()
+    img_large = img.scaled(*large_size, aspectRatioMode=QtCore.Qt.KeepAspectRatio, transformMode=QtCore.Qt.FastTransformation)
+    img_resized = img.scaled(*small_size, aspectRatioMode=QtCore.Qt.KeepAspectRatio, transformMode=QtCore.Qt.FastTransformation)
+    return img_resized, img_large
+
+
+class ThumbnailCache(object):
+    """On-disk LRU cache of gallery thumbnails keyed by (path, mtime, size).
+
+    Every entry is a single file holding both JPEG encoded images, the index
+    keeps the LRU order and is written back by flush().
+    """
+    def __init__(self, folder=cache_folder, max_bytes=64 * 1024 * 1024):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.index = OrderedDict()
+        self.paths = {}
+        self.total_bytes = 0
+        self.dirty = False
+
+        os.makedirs(folder, exist_ok=True)
+        self.load_index()
+
+    def index_path(self,):
+        return os.path.join(self.folder, "index.json")
+
+    def entry_path(self, key):
+        return os.path.join(self.folder, f"{key}.thm")
+
+    def load_index(self,):
+        try:
+            with open(self.index_path()) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = []
+
+        for key, path, nbytes in entries:
+            if os.path.exists(self.entry_path(key)):
+                self.index[key] = [path, nbytes]
+                self.paths[path] = key
+                self.total_bytes += nbytes
+
+    def flush(self,):
+        with self.lock:
+            if not self.dirty:
+                return
+            entries = [[key, path, nbytes] for key, (path, nbytes) in self.index.items()]
+            tmp_path = self.index_path() + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.index_path())
+            self.dirty = False
+
+    def make_key(self, path):
+        st = os.stat(path)
+        return hashlib.sha1(f"{path}|{st.st_mtime_ns}|{st.st_size}".encode()).hexdigest()
+
+    def get(self, path):
+        path = os.path.abspath(path)
+        try:
+            key = self.make_key(path)
+        except OSError:
+            return None
+
+        with self.lock:
+            if key not in self.index:
+                return None
+            self.index.move_to_end(key)
+            self.dirty = True
+            try:
+                with open(self.entry_path(key), "rb") as f:
+                    data = f.read()
+            except OSError:
+                self.drop(key)
+                return None
+
+        if data[:4] != entry_magic:
+            return None
+        small_len, large_len = struct.unpack("<II", data[4:12])
+        small = decode_image(data[12:12 + small_len])
+        large = decode_image(data[12 + small_len:12 + small_len + large_len])
+        return small, large
+
+    def put(self, path, small, large):
+        path = os.path.abspath(path)
+        try:
+            key = self.make_key(path)
+        except OSError:
+            return
+        small_data = encode_image(small)
+        large_data = encode_image(large)
+        data = entry_magic + struct.pack("<II", len(small_data), len(large_data)) + small_data + large_data
+
+        with self.lock:
+            old_key = self.paths.get(path)
+            if old_key is not None:
+                self.drop(old_key)
+            with open(self.entry_path(key), "wb") as f:
+                f.write(data)
+            self.index[key] = [path, len(data)]
+            self.paths[path] = key
+            self.total_bytes += len(data)
+            self.dirty = True
+            self.evict()
+
+    def load(self, path):
+        """Return (75x75, 320x240) images for path, decoding only on a cache miss."""
+        cached = self.get(path)
+        if cached is not None:
+            return cached
+
+        with instrument.span("gallery_load.decode"):
+            small, large = decode_thumbnails(path)
+        if not small.isNull():
+            with instrument.span("gallery_load.write"):
+                self.put(path, small, large)
+        return small, large
+
+    def invalidate(self, path):
+        path = os.path.abspath(path)
+        with self.lock:
+            key = self.paths.get(path)
+            if key is not None:
+                self.drop(key)
+
+    def drop(self, key):
+        path, nbytes = self.index.pop(key)
+        if self.paths.get(path) == key:
+            del self.paths[path]
+        self.total_bytes -= nbytes
+        self.dirty = True
+        try:
+            os.remove(self.entry_path(key))
+        except OSError:
+            pass
+
+    def evict(self,):
+        while self.total_bytes > self.max_bytes and len(self.index) > 1:
+            self.drop(next(iter(self.index)))